@@ -11,88 +11,820 @@ import os
 import time
 import torch
 import numpy as np
+import base64
 import copy
+import hashlib
+import heapq
 import json
+import multiprocessing
+import platform
+import queue
 import random
+import re
+import shutil
+import struct
+import threading
 import uuid
-from PIL import ImageDraw, Image, ImageFont
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+from multiprocessing import shared_memory
+from PIL import ImageDraw, Image, ImageFont, ImageSequence
+from pydantic import BaseModel, Field
 
 import matplotlib.pylab as plt
 
-import modules.txt2img
+from contextlib import closing
 from modules import script_callbacks
-from modules import devices, images
+from modules import devices, images, processing
+from modules.processing import StableDiffusionProcessingTxt2Img
+from modules.ui_common import plaintext_to_html
 from modules.deepbooru import DeepDanbooru
 from modules import shared
 from modules.extras import run_pnginfo
 from modules.ui_components import FormRow, FormGroup, ToolButton, FormHTML, InputAccordion, ResizeHandleRow
 
+# scripts.basedir() only points at the extension while its scripts are imported
+base_dir = scripts.basedir()
+
 class DeepDanbooruWrapper:
 
     def __init__(
         self,
+        classifier = None
     ):
 
-        self.dd_classifier = DeepDanbooru()
-        self.cache = {}
+        # Any object with start/stop and a callable model exposing tags can stand in for DeepDanbooru
+        self.dd_classifier = classifier if classifier is not None else DeepDanbooru()
+        # Ordered by last use, see trim_cache
+        self.cache = OrderedDict()
         self.enable_cache = True
+        self.started = False
+        self.loaded = False
+        self.tags = []
+        self.tag_index = {}
+        self.batch_size = 8
+        # Torch threads while the classifier runs on the CPU, None keeps the webui setting
+        self.threads = None
+        self.pool = None
+        self.use_pool = True
+        self.use_profile = True
 
     def start(self):
-        print("Starting DeepDanboru")
-        self.dd_classifier.start()
+        # The model is loaded on the first evaluation, so requests answered
+        # from a cache never pay for loading it
+        self.started = True
+
+    def load(self):
+        if self.loaded:
+            self.refresh_pool()
+
+        if not self.loaded:
+            self.pool = DeepDanbooruProcessPool.from_options() if self.use_pool else None
+
+            if self.pool is not None:
+                tags = self.pool.tags
+            else:
+                print("Starting DeepDanboru")
+                self.dd_classifier.start()
+                tags = self.dd_classifier.model.tags
+
+            self.loaded = True
+            self.tags = list(tags)
+            self.tag_index = {
+                tag: i for i, tag in enumerate(self.tags) if not tag.startswith("rating:")
+            }
+
+            if self.pool is None and self.use_profile:
+                DeepDanbooruAutotuner.apply(self)
+
+    def refresh_pool(self):
+
+        # The shared pool is closed and replaced when its settings change, a held one may be stale
+        if not self.use_pool:
+            return
+
+        pool = DeepDanbooruProcessPool.from_options()
+        if pool is self.pool:
+            return
+
+        if pool is None:
+            print("Starting DeepDanboru")
+            self.dd_classifier.start()
+            if self.use_profile:
+                DeepDanbooruAutotuner.apply(self)
+        elif self.pool is None:
+            print("Stopping DeepDanboru")
+            self.dd_classifier.stop()
+
+        self.pool = pool
 
     def stop(self):
-        print("Stopping DeepDanboru")
-        self.dd_classifier.stop()
+        if self.loaded and self.pool is None:
+            print("Stopping DeepDanboru")
+            self.dd_classifier.stop()
+        self.started = False
+        self.loaded = False
+        self.pool = None
 
-    def evaluate_model(self, pil_image, image_id="", minimal_threshold=0):
+    def batch_capacity(self):
 
-        if self.enable_cache:
-            if image_id and image_id in self.cache:
-                return self.cache[image_id]
+        self.load()
+        if self.pool is not None:
+            return self.pool.capacity
 
-        # Input image should be 512x512 before reach this point
+        return self.batch_size
 
+    @staticmethod
+    def preprocess(pil_image):
+        # Input image should be 512x512 before reach this point
         pic = images.resize_image(0, pil_image.convert("RGB"), 512, 512)
+        return np.asarray(pic, dtype=np.uint8)
+
+    def run_model(self, arrays):
+
+        # The thread count is process wide, it is only changed for the classifier calls
+        previous_threads = torch.get_num_threads()
+        if self.threads:
+            torch.set_num_threads(self.threads)
+
+        try:
+            return self.run_batches(arrays)
+        finally:
+            torch.set_num_threads(previous_threads)
+
+    def run_batches(self, arrays):
+
+        outputs = []
+        start = 0
+        while start < len(arrays):
+            a = arrays[start:start + self.batch_size].astype(np.float32) / 255
+
+            try:
+                with torch.no_grad(), devices.autocast():
+                    x = torch.from_numpy(a).to(devices.device)
+                    y = self.dd_classifier.model(x).detach().cpu().numpy().astype(np.float32)
+            except (RuntimeError, MemoryError) as e:
+                # Back off to smaller batches when an allocation fails
+                if self.batch_size == 1 or not DeepDanbooruAutotuner.is_allocation_error(e):
+                    raise
+                self.batch_size = max(1, self.batch_size // 2)
+                print(f"Img2Txt: allocation failed, batch size reduced to {self.batch_size}")
+                devices.torch_gc()
+                continue
 
-        #pic = pil_image.convert("RGB")
-        a = np.expand_dims(np.array(pic, dtype=np.float32), 0) / 255
+            outputs.extend(y)
+            start += len(a)
 
-        with torch.no_grad(), devices.autocast():
-            x = torch.from_numpy(a).to(devices.device)
-            y = self.dd_classifier.model(x)[0].detach().cpu().numpy()
+        return outputs
 
-        probability_dict = {}
-        for tag, probability in zip(self.dd_classifier.model.tags, y):
+    def evaluate_batch(self, pil_images, image_ids):
 
-            if probability < minimal_threshold:
+        results = [None] * len(pil_images)
+        pending = []
+        for i, image_id in enumerate(image_ids):
+            if not self.is_cached(image_id):
+                pending.append(i)
                 continue
 
-            if tag.startswith("rating:"):
+            # A retained wrapper may be trimmed by another session in between
+            try:
+                results[i] = self.cache[image_id]
+                self.cache.move_to_end(image_id)
+            except KeyError:
+                if results[i] is None:
+                    pending.append(i)
+
+        if not pending:
+            return results
+
+        self.load()
+
+        arrays = np.stack([self.preprocess(pil_images[i]) for i in pending])
+        if self.pool is not None:
+            outputs = self.pool.evaluate(arrays)
+        else:
+            outputs = self.run_model(arrays)
+
+        for i, y in zip(pending, outputs):
+            results[i] = y
+            if self.enable_cache and image_ids[i]:
+                self.cache[image_ids[i]] = y
+
+        return results
+
+    def is_cached(self, image_id):
+        return self.enable_cache and bool(image_id) and image_id in self.cache
+
+    def trim_cache(self, max_entries):
+
+        # Least recently used first
+        excess = len(self.cache) - max_entries
+        for image_id in list(self.cache)[:max(0, excess)]:
+            del self.cache[image_id]
+
+    def has_tag(self, tag):
+        return tag in self.tag_index
+
+    def tag_probability(self, probabilities, tag):
+
+        if tag not in self.tag_index:
+            return 0
+
+        return probabilities[self.tag_index[tag]]
+
+    def evaluate_vector(self, pil_image, image_id=""):
+
+        # The cache keeps the raw probability vector, thresholds are applied by the callers
+        return self.evaluate_batch([pil_image], [image_id])[0]
+
+    def evaluate_model(self, pil_image, image_id="", minimal_threshold=0):
+
+        y = self.evaluate_vector(pil_image, image_id)
+        return self.probabilities_to_tags(y, minimal_threshold)
+
+    def probabilities_to_tags(self, y, minimal_threshold=0):
+
+        probability_dict = {}
+        for tag, i in self.tag_index.items():
+
+            probability = y[i]
+            if probability < minimal_threshold:
                 continue
 
             probability_dict[tag] = probability
 
-        if self.enable_cache:
-            self.cache[image_id] = probability_dict
-
         return probability_dict
 
+def _process_pool_worker(task_queue, result_queue, input_name, threads):
+
+    # Runs in a forked process with its own CPU copy of the model
+    torch.set_num_threads(threads)
+
+    classifier = DeepDanbooru()
+    classifier.load()
+    classifier.model.to(torch.device("cpu"), torch.float32)
+    tags = list(classifier.model.tags)
+    result_queue.put(("ready", tags))
+
+    inputs = shared_memory.SharedMemory(name=input_name)
+    outputs = None
+
+    while True:
+        message = task_queue.get()
+
+        if message[0] == "stop":
+            break
+
+        if message[0] == "outputs":
+            outputs = shared_memory.SharedMemory(name=message[1])
+            continue
+
+        count = message[1]
+        batch = np.ndarray((count, 512, 512, 3), dtype=np.uint8, buffer=inputs.buf)
+        x = torch.from_numpy(batch.astype(np.float32) / 255)
+
+        with torch.no_grad():
+            y = classifier.model(x).numpy()
+
+        result = np.ndarray((count, len(tags)), dtype=np.float32, buffer=outputs.buf)
+        result[:] = y
+        result_queue.put(("done", count))
+
+    inputs.close()
+    if outputs is not None:
+        outputs.close()
+
+class DeepDanbooruProcessPool:
+
+    instance = None
+    lock = threading.Lock()
+
+    def __init__(
+        self,
+        workers = 2,
+        threads = 1,
+        max_batch = 8
+    ):
+
+        # Fork keeps this script importable in the workers, it is not available on Windows
+        context = multiprocessing.get_context("fork")
+
+        self.workers_count = workers
+        self.threads = threads
+        self.max_batch = max_batch
+        self.capacity = workers * max_batch
+        self.workers = []
+        self.tags = []
+
+        for i in range(workers):
+            inputs = shared_memory.SharedMemory(create=True, size=max_batch * 512 * 512 * 3)
+            task_queue = context.Queue()
+            result_queue = context.Queue()
+            process = context.Process(
+                target=_process_pool_worker,
+                args=(task_queue, result_queue, inputs.name, threads),
+                daemon=True
+            )
+            process.start()
+            self.workers.append({
+                "process": process,
+                "tasks": task_queue,
+                "results": result_queue,
+                "inputs": inputs,
+                "outputs": None
+            })
+
+        for worker in self.workers:
+            _, self.tags = self.receive(worker)
+
+            worker["outputs"] = shared_memory.SharedMemory(create=True, size=max_batch * len(self.tags) * 4)
+            worker["tasks"].put(("outputs", worker["outputs"].name))
+
+        print(f"Img2Txt: started {workers} DeepDanbooru workers with {threads} threads each")
+
+    @staticmethod
+    def from_options():
+
+        workers = int(shared.opts.img2txt_cpu_pool_workers)
+        threads = int(shared.opts.img2txt_cpu_pool_threads)
+
+        with DeepDanbooruProcessPool.lock:
+            pool = DeepDanbooruProcessPool.instance
+
+            if pool is not None and (workers != pool.workers_count or threads != pool.threads):
+                pool.close()
+                pool = None
+
+            if pool is None and workers > 0:
+                try:
+                    pool = DeepDanbooruProcessPool(workers, threads)
+                except ValueError as e:
+                    print(f"Img2Txt: CPU worker pool is not available on this platform: {e}")
+
+            DeepDanbooruProcessPool.instance = pool
+            return pool
+
+    def receive(self, worker):
+
+        while True:
+            try:
+                return worker["results"].get(timeout=1)
+            except queue.Empty:
+                if not worker["process"].is_alive():
+                    raise RuntimeError("DeepDanbooru worker process died")
+
+    def evaluate(self, arrays):
+
+        # Contiguous slices go to each worker, results are gathered back in input order
+        outputs = np.zeros((len(arrays), len(self.tags)), dtype=np.float32)
+
+        with DeepDanbooruProcessPool.lock:
+            if not self.workers:
+                raise RuntimeError("DeepDanbooru worker pool is closed")
+
+            for start in range(0, len(arrays), self.capacity):
+
+                assigned = []
+                for i, worker in enumerate(self.workers):
+                    first = start + i * self.max_batch
+                    batch = arrays[first:first + self.max_batch]
+                    if not len(batch):
+                        break
+
+                    buffer = np.ndarray(batch.shape, dtype=np.uint8, buffer=worker["inputs"].buf)
+                    buffer[:] = batch
+                    worker["tasks"].put(("run", len(batch)))
+                    assigned.append((worker, first, len(batch)))
+
+                for worker, first, count in assigned:
+                    self.receive(worker)
+                    result = np.ndarray((count, len(self.tags)), dtype=np.float32, buffer=worker["outputs"].buf)
+                    outputs[first:first + count] = result
+
+        return list(outputs)
+
+    def close(self):
+
+        for worker in self.workers:
+            worker["tasks"].put(("stop",))
+            worker["process"].join(timeout=10)
+
+            for name in ("inputs", "outputs"):
+                if worker[name] is not None:
+                    worker[name].close()
+                    worker[name].unlink()
+
+        self.workers = []
+
+    @staticmethod
+    def benchmark(max_workers, threads=1, windows=64):
+
+        # Windows/second for 1 to max_workers workers on random 512x512 windows
+        arrays = np.random.randint(0, 256, (windows, 512, 512, 3), dtype=np.uint8)
+        results = []
+
+        for workers in range(1, int(max_workers) + 1):
+            pool = DeepDanbooruProcessPool(workers, threads)
+            try:
+                pool.evaluate(arrays[:pool.capacity])
+                start = time.perf_counter()
+                pool.evaluate(arrays)
+                elapsed = time.perf_counter() - start
+            finally:
+                pool.close()
+
+            results.append((workers, windows / elapsed))
+            print(f"Img2Txt pool benchmark: {workers} workers x {threads} threads, {windows / elapsed:.2f} windows/s")
+
+        return results
+
+class DeepDanbooruAutotuner:
+
+    batch_sizes = (1, 2, 4, 8, 16, 32)
+
+    @staticmethod
+    def profile_path():
+        return os.path.join(base_dir, "autotune.json")
+
+    @staticmethod
+    def load_profiles():
+
+        path = DeepDanbooruAutotuner.profile_path()
+        if not os.path.exists(path):
+            return {}
+
+        try:
+            with open(path, "r") as _f:
+                return json.loads(_f.read())
+        except (OSError, ValueError) as e:
+            print(f"Img2Txt: could not read autotune profile {path}: {e}")
+            return {}
+
+    @staticmethod
+    def save_profiles(profiles):
+
+        path = DeepDanbooruAutotuner.profile_path()
+        with open(path, "w") as _f:
+            _f.write(json.dumps(profiles, indent=4))
+
+    @staticmethod
+    def is_allocation_error(e):
+
+        message = str(e).lower()
+        return isinstance(e, MemoryError) or "out of memory" in message or "alloc" in message
+
+    @staticmethod
+    def profile_key(wrapper):
+
+        device = str(devices.device)
+        if device.startswith("cuda"):
+            hardware = torch.cuda.get_device_name(devices.device)
+        else:
+            hardware = f"{platform.processor() or platform.machine()} x{os.cpu_count()}"
+
+        model = hashlib.sha1("\n".join(wrapper.tags).encode()).hexdigest()[:12]
+        return f"{device}|{hardware}|deepdanbooru-{model}"
+
+    @staticmethod
+    def apply(wrapper):
+
+        profile = DeepDanbooruAutotuner.load_profiles().get(DeepDanbooruAutotuner.profile_key(wrapper))
+        if not profile:
+            return None
+
+        wrapper.batch_size = profile["batch_size"]
+        if devices.device.type == "cpu":
+            wrapper.threads = profile["threads"]
+
+        return profile
+
+    @staticmethod
+    def thread_candidates():
+
+        # Intra-op threads only matter when the classifier runs on the CPU
+        if devices.device.type != "cpu":
+            return [torch.get_num_threads()]
+
+        cores = os.cpu_count() or 1
+        return sorted({1, max(1, cores // 4), max(1, cores // 2), cores})
+
+    @staticmethod
+    def calibrate(windows=32):
+
+        wrapper = DeepDanbooruWrapper()
+        wrapper.use_pool = False
+        wrapper.use_profile = False
+        wrapper.load()
+
+        arrays = np.random.randint(0, 256, (windows, 512, 512, 3), dtype=np.uint8)
+        previous_threads = torch.get_num_threads()
+        results = []
+        best = None
+
+        try:
+            for threads in DeepDanbooruAutotuner.thread_candidates():
+                torch.set_num_threads(threads)
+
+                for batch_size in DeepDanbooruAutotuner.batch_sizes:
+                    if batch_size > windows:
+                        break
+
+                    wrapper.batch_size = batch_size
+                    try:
+                        wrapper.run_model(arrays[:batch_size])
+                        start = time.perf_counter()
+                        wrapper.run_model(arrays)
+                        elapsed = time.perf_counter() - start
+                    except (RuntimeError, MemoryError) as e:
+                        if not DeepDanbooruAutotuner.is_allocation_error(e):
+                            raise
+                        # Larger batches will not fit either
+                        print(f"Img2Txt autotune: batch size {batch_size} does not fit, backing off")
+                        devices.torch_gc()
+                        break
+
+                    # run_model may have reduced the batch size by itself
+                    if wrapper.batch_size != batch_size:
+                        break
+
+                    rate = windows / elapsed
+                    results.append({"threads": threads, "batch_size": batch_size, "windows_per_second": rate})
+                    print(f"Img2Txt autotune: {threads} threads, batch size {batch_size}, {rate:.2f} windows/s")
+
+                    if best is None or rate > best["windows_per_second"]:
+                        best = results[-1]
+        finally:
+            torch.set_num_threads(previous_threads)
+            wrapper.stop()
+
+        if best is not None:
+            profiles = DeepDanbooruAutotuner.load_profiles()
+            profiles[DeepDanbooruAutotuner.profile_key(wrapper)] = dict(best, results=results, created=time.time())
+            DeepDanbooruAutotuner.save_profiles(profiles)
+
+        return best
+
+class DeepDanbooruHashIndex:
+
+    def __init__(
+        self,
+        index_path,
+        max_distance=4,
+        max_entries=5000,
+        max_color_distance=24
+    ):
+
+        self.index_path = index_path
+        self.max_distance = max_distance
+        self.max_color_distance = max_color_distance
+        self.max_entries = max_entries
+        self.entries = []
+        self.tree = None
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_time = 0.0
+
+        self.load()
+
+    @staticmethod
+    def dhash(pil_image, hash_size=8):
+        # Difference hash: one bit per horizontal gradient of a tiny grayscale copy
+        small = pil_image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0)
+        pixels = np.asarray(small, dtype=np.int16)
+        bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+        return int.from_bytes(bits.tobytes(), "big")
+
+    @staticmethod
+    def thumbnail(pil_image, size=8):
+        # Color thumbnail confirming a hash match, the hash only sees luminance gradients
+        small = pil_image.convert("RGB").resize((size, size), Image.BILINEAR, reducing_gap=2.0)
+        return np.asarray(small, dtype=np.uint8).tobytes().hex()
+
+    @staticmethod
+    def is_informative(pil_image, hash_size=8, min_deviation=2.0):
+        # Flat or near-uniform images all share the same hash
+        small = pil_image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0)
+        return float(np.asarray(small, dtype=np.float32).std()) >= min_deviation
+
+    @staticmethod
+    def distance(hash_a, hash_b):
+        return bin(hash_a ^ hash_b).count("1")
+
+    @staticmethod
+    def color_distance(thumbnail_a, thumbnail_b):
+
+        if not thumbnail_a or not thumbnail_b or len(thumbnail_a) != len(thumbnail_b):
+            return None
+
+        a = np.frombuffer(bytes.fromhex(thumbnail_a), dtype=np.uint8).astype(np.int16)
+        b = np.frombuffer(bytes.fromhex(thumbnail_b), dtype=np.uint8).astype(np.int16)
+        return int(np.abs(a - b).max())
+
+    def same_colors(self, entry, thumbnail):
+
+        distance = self.color_distance(entry.get("thumbnail"), thumbnail)
+        return distance is not None and distance <= self.max_color_distance
+
+    def load(self):
+
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r") as _f:
+                    self.entries = json.loads(_f.read())
+            except (OSError, ValueError) as e:
+                print(f"Img2Txt: could not read hash index {self.index_path}: {e}")
+                self.entries = []
+
+        self.rebuild()
+
+    def save(self):
+
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as _f:
+            _f.write(json.dumps(self.entries))
+        os.replace(tmp_path, self.index_path)
+
+    def rebuild(self):
+
+        # BK-tree node: [hash, [entry indexes], {distance: child node}]
+        self.tree = None
+        for i, entry in enumerate(self.entries):
+            self.insert(int(entry["hash"], 16), i)
+
+    def insert(self, image_hash, entry_index):
+
+        if self.tree is None:
+            self.tree = [image_hash, [entry_index], {}]
+            return
+
+        node = self.tree
+        while True:
+            d = self.distance(image_hash, node[0])
+            if d == 0:
+                # Images differing only in color share a hash
+                node[1].append(entry_index)
+                return
+            if d not in node[2]:
+                node[2][d] = [image_hash, [entry_index], {}]
+                return
+            node = node[2][d]
+
+    def search(self, image_hash, max_distance, accept=None):
+
+        if self.tree is None:
+            return None, None
+
+        best_index, best_distance = None, None
+        nodes = [self.tree]
+        while nodes:
+            node = nodes.pop()
+            d = self.distance(image_hash, node[0])
+
+            if d <= max_distance and (best_distance is None or d < best_distance):
+                for entry_index in reversed(node[1]):
+                    if accept is None or accept(self.entries[entry_index]):
+                        best_index, best_distance = entry_index, d
+                        break
+
+            for child_distance, child in node[2].items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    nodes.append(child)
+
+        return best_index, best_distance
+
+    def lookup(self, image_hash, accept=None, max_distance=None):
+
+        if max_distance is None:
+            max_distance = self.max_distance
+
+        with self.lock:
+            start = time.perf_counter()
+            entry_index, distance = self.search(image_hash, max_distance, accept)
+            self.lookup_time += time.perf_counter() - start
+            self.lookups += 1
+
+            if entry_index is None:
+                return None, None
+
+            self.hits += 1
+            return self.entries[entry_index], distance
+
+    def get_entry(self, image_hash, thumbnail):
+
+        with self.lock:
+            entry_index, _ = self.search(image_hash, 0, lambda e: self.same_colors(e, thumbnail))
+            if entry_index is not None:
+                return self.entries[entry_index]
+
+            entry = {
+                "hash": f"{image_hash:016x}",
+                "thumbnail": thumbnail,
+                "threshold": None,
+                "tags": {},
+                "markers": {}
+            }
+            self.entries.append(entry)
+
+            if len(self.entries) > self.max_entries:
+                self.entries = self.entries[-self.max_entries:]
+                self.rebuild()
+            else:
+                self.insert(image_hash, len(self.entries) - 1)
+
+            return entry
+
+    def store_tags(self, image_hash, thumbnail, minimal_threshold, tag_probs):
+
+        entry = self.get_entry(image_hash, thumbnail)
+        with self.lock:
+            entry["threshold"] = float(minimal_threshold)
+            entry["tags"] = {tag: float(prob) for tag, prob in tag_probs.items()}
+            self.save()
+
+    def store_markers(self, image_hash, thumbnail, key, figures):
+
+        entry = self.get_entry(image_hash, thumbnail)
+        with self.lock:
+            entry["markers"][key] = [
+                {k: (float(v) if k == "prob" else int(v)) for k, v in figure.items()}
+                for figure in figures
+            ]
+            self.save()
+
+    def find_tags(self, image_hash, thumbnail, minimal_threshold):
+
+        # Only usable when the stored probabilities were not cut above what is asked now
+        entry, distance = self.lookup(
+            image_hash,
+            lambda e: e["threshold"] is not None and e["threshold"] <= minimal_threshold and self.same_colors(e, thumbnail)
+        )
+
+        if entry is None:
+            return None, None
+
+        tags = {tag: prob for tag, prob in entry["tags"].items() if prob >= minimal_threshold}
+        return tags, distance
+
+    def find_markers(self, image_hash, thumbnail, key):
+
+        # Boxes of a crop or a shifted variant would be misplaced, only exact hashes are reused
+        entry, distance = self.lookup(image_hash, lambda e: key in e["markers"] and self.same_colors(e, thumbnail), max_distance=0)
+
+        if entry is None:
+            return None, None
+
+        return entry["markers"][key], distance
+
+    def stats(self):
+
+        hit_rate = self.hits / self.lookups if self.lookups else 0
+        latency = (self.lookup_time / self.lookups) * 1000 if self.lookups else 0
+        return f"hash index: {len(self.entries)} images, hit rate {hit_rate:.0%} ({self.hits}/{self.lookups}), lookup {latency:.3f} ms"
+
+@lru_cache(maxsize=8)
+def load_marker_font(size):
+    font_path = os.path.abspath(os.path.join(__file__, "..", "..", "resources", "Arial.ttf"))
+    return ImageFont.truetype(font_path, size)
+
 class DeepDanbooruObjectDrawer:
 
     def __init__(
         self,
         pil_image,
         title,
-        export_directory
+        artifacts
     ):
 
-        w, h = pil_image.size
-        self.original_pil_image = self.resize(pil_image, max(w, h))
-        self.rect_pil_image = self.original_pil_image.copy()
+        self.source_pil_image = pil_image
+        # Shared with clones so the full resolution square is built once
+        self.resized_images = {}
         self.pil_image = self.resize(pil_image, 512)
+        # Markers are only rasterized at preview resolution
+        self.rect_pil_image = self.pil_image.copy()
         self.title = title
-        self.export_directory = export_directory
+        self.artifacts = artifacts
+
+    @property
+    def original_pil_image(self):
+
+        # Full resolution square is only needed for exported crops
+        if "ORIG" not in self.resized_images:
+            w, h = self.source_pil_image.size
+            self.resized_images["ORIG"] = self.resize(self.source_pil_image, max(w, h))
+
+        return self.resized_images["ORIG"]
+
+    def clone(self, title):
+
+        drawer = copy.copy(self)
+        drawer.title = title
+        return drawer
 
     def resize(self, pil_image, to_scale):
 
@@ -149,8 +881,7 @@ class DeepDanbooruObjectDrawer:
         background.paste(im2, (x1, y1))
 
         if export:
-            prefix = f"{self.export_directory}/{self.title}_{top}_{left}_{bottom}_{right}"
-            background.save(f"{prefix}.png")
+            self.artifacts.save_image(f"{self.title}_{top}_{left}_{bottom}_{right}.png", background)
 
         return background
 
@@ -168,10 +899,9 @@ class DeepDanbooruObjectDrawer:
             0
         )
 
-        font_path = os.path.abspath(os.path.join(__file__, "..", "..", "resources", "Arial.ttf"))
         line_width = int((im1.size[0]/512) * 1.5)
         text_width = int((im1.size[0]/512) * 10)
-        font = ImageFont.truetype(font_path, text_width)
+        font = load_marker_font(text_width)
 
         top = int((borders["top"]/512) * im1.size[0])
         left = int((borders["left"]/512) * im1.size[0])
@@ -196,6 +926,140 @@ class DeepDanbooruObjectDrawer:
 
         self.rect_pil_image = im1
 
+class DeepDanbooruDensityMap:
+
+    @staticmethod
+    def accumulate(windows, probabilities, size=512):
+
+        # Every window adds its probability over its footprint through the four corners
+        # of a difference array, two cumulative sums then give each pixel the sum over
+        # the windows covering it: O(pixels + windows)
+        sums = np.zeros((size + 1, size + 1), dtype=np.float64)
+        counts = np.zeros((size + 1, size + 1), dtype=np.float64)
+
+        if len(windows):
+            windows = np.asarray(windows, dtype=np.int64)
+            probabilities = np.asarray(probabilities, dtype=np.float64)
+
+            # Windows not evaluated (budget) do not count
+            valid = ~np.isnan(probabilities)
+            windows, probabilities = windows[valid], probabilities[valid]
+            top, left, bottom, right = windows.T
+            ones = np.ones_like(probabilities)
+
+            for values, target in ((probabilities, sums), (ones, counts)):
+                np.add.at(target, (top, left), values)
+                np.add.at(target, (top, right), -values)
+                np.add.at(target, (bottom, left), -values)
+                np.add.at(target, (bottom, right), values)
+
+        sums = sums.cumsum(axis=0).cumsum(axis=1)[:size, :size]
+        counts = counts.cumsum(axis=0).cumsum(axis=1)[:size, :size]
+
+        # Mean probability of the windows covering each pixel, 0 where none does
+        density = np.zeros((size, size), dtype=np.float32)
+        np.divide(sums, counts, out=density, where=counts > 0.5, casting="unsafe")
+        return density
+
+    @staticmethod
+    def content_box(pil_image, size=512):
+
+        # Area of the padded square covered by the image, as in DeepDanbooruObjectDrawer.resize
+        width, height = pil_image.size
+        if width > height:
+            new_h = int(size * (height/width))
+            y1 = int((size - new_h)/2)
+            return 0, y1, size, y1 + new_h
+
+        new_w = int(size * (width/height))
+        x1 = int((size - new_w)/2)
+        return x1, 0, x1 + new_w, size
+
+    @staticmethod
+    def preview_image(density, pil_image):
+
+        # Density map over the image area of the 512 preview
+        im = Image.fromarray((np.clip(density, 0, 1) * 255).astype(np.uint8), "L")
+        return im.crop(DeepDanbooruDensityMap.content_box(pil_image, density.shape[0]))
+
+    @staticmethod
+    def to_image(density, pil_image):
+
+        # Density map at the resolution of the source image, only built on demand
+        return DeepDanbooruDensityMap.preview_image(density, pil_image).resize(pil_image.size, Image.BILINEAR)
+
+    @staticmethod
+    def boxes(density, windows, threshold, size=512):
+
+        # The density is constant between window edges, so connected components
+        # are searched on that cell grid instead of on pixels
+        ys = sorted({0, size} | {w[0] for w in windows} | {w[2] for w in windows})
+        xs = sorted({0, size} | {w[1] for w in windows} | {w[3] for w in windows})
+        cells = density[np.ix_(ys[:-1], xs[:-1])]
+        mask = cells > threshold
+
+        labels = np.zeros(mask.shape, dtype=np.int32)
+        boxes = []
+        for start in zip(*np.nonzero(mask)):
+            if labels[start]:
+                continue
+
+            labels[start] = len(boxes) + 1
+            stack = [start]
+            rows, cols = [], []
+            while stack:
+                row, col = stack.pop()
+                rows.append(row)
+                cols.append(col)
+                for next_row, next_col in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+                    if 0 <= next_row < mask.shape[0] and 0 <= next_col < mask.shape[1] and \
+                       mask[next_row, next_col] and not labels[next_row, next_col]:
+                        labels[next_row, next_col] = len(boxes) + 1
+                        stack.append((next_row, next_col))
+
+            boxes.append({
+                "top": int(ys[min(rows)]),
+                "left": int(xs[min(cols)]),
+                "bottom": int(ys[max(rows) + 1]),
+                "right": int(xs[max(cols) + 1]),
+                "prob": float(cells[rows, cols].max())
+            })
+
+        return boxes
+
+class DeepDanbooruLocalizationBudget:
+
+    def __init__(
+        self,
+        deadline = 0,
+        max_evaluations = 0
+    ):
+
+        # A limit of 0 disables that limit
+        self.deadline_at = time.perf_counter() + deadline if deadline else None
+        self.max_evaluations = int(max_evaluations)
+        self.evaluations = 0
+
+    def remaining(self):
+
+        if self.exhausted():
+            return 0
+
+        if self.max_evaluations:
+            return self.max_evaluations - self.evaluations
+
+        return float("inf")
+
+    def exhausted(self):
+
+        if self.max_evaluations and self.evaluations >= self.max_evaluations:
+            return True
+
+        return self.deadline_at is not None and time.perf_counter() >= self.deadline_at
+
+    def spend(self, evaluations):
+        self.evaluations += evaluations
+
 class DeepDanbooruObjectRecognitionNode:
 
     def __init__(
@@ -203,51 +1067,97 @@ class DeepDanbooruObjectRecognitionNode:
         dd_wrapper,
         pil_image,
         tag,
-        export_directory
+        artifacts,
+        drawer = None
     ):
         self.dd_wrapper = dd_wrapper
         self.tag = tag
 
-        self.export_directory = export_directory
+        self.artifacts = artifacts
 
-        self.drawer = DeepDanbooruObjectDrawer(
-            pil_image,
-            tag,
-            self.export_directory
-        )
+        if drawer is not None:
+            self.drawer = drawer.clone(tag)
+        else:
+            self.drawer = DeepDanbooruObjectDrawer(
+                pil_image,
+                tag,
+                self.artifacts
+            )
 
         self.pil_image = self.drawer.pil_image.copy()
+        self.grid = None
+
+    def evaluate_window(self, top, left, bottom, right):
+
+        # Windows already evaluated for this image are not cropped again
+        iid = f'{top}-{left}-{bottom}-{right}'
+        im1 = None if self.dd_wrapper.is_cached(iid) else self.drawer.crop(top, left, bottom, right)
+        y = self.dd_wrapper.evaluate_vector(im1, iid)
+        return self.dd_wrapper.tag_probability(y, self.tag)
+
+    def is_window_cached(self, window):
+        return self.dd_wrapper.is_cached('{}-{}-{}-{}'.format(*window))
+
+    def evaluate_windows(self, windows, budget=None):
+
+        # Evaluates the windows not cached yet in classifier sized batches
+        pending = [w for w in windows if not self.is_window_cached(w)]
+        if not pending:
+            return
 
+        capacity = self.dd_wrapper.batch_capacity()
+        for start in range(0, len(pending), capacity):
 
-    def create_heatmaps(self, kernel_size_x, kernel_size_y, step_x, step_y, minimal_percentage):
+            chunk = pending[start:start + capacity]
+            if budget is not None:
+                if budget.exhausted():
+                    break
+                chunk = chunk[:int(min(len(chunk), budget.remaining()))]
+                budget.spend(len(chunk))
+
+            self.dd_wrapper.evaluate_batch(
+                [self.drawer.crop(*w) for w in chunk],
+                ['{}-{}-{}-{}'.format(*w) for w in chunk]
+            )
+
+    def create_heatmaps(self, kernel_size_x, kernel_size_y, step_x, step_y, minimal_percentage, merge_duplicates=True, budget=None,
+                        box_source="windows", cached_only=False, write_artifacts=True):
+
+        # With a budget the windows were already scheduled by the caller, the ones it
+        # did not reach are left out, as are all uncached windows when only recomputing
+        cached_only = cached_only or budget is not None
+        if not cached_only:
+            self.evaluate_windows([
+                (top, left, top + kernel_size_y, left + kernel_size_x)
+                for top in range(0, 512 - kernel_size_y, step_y)
+                for left in range(0, 512 - kernel_size_x, step_x)
+            ])
 
         # Headmap approach
         current_y = 0
-        dots = []
+        grid = []
+        windows = []
         bests = []
 
         while current_y + kernel_size_y < 512:
 
             current_x = 0
-            x_dots = []
+            x_grid = []
 
             while current_x + kernel_size_x < 512:
 
-                im1 = self.drawer.crop(
-                    current_y,
-                    current_x,
-                    current_y + kernel_size_y,
-                    current_x + kernel_size_x,
-                    #export=True
-                )
-
                 iid = f'{current_y}-{current_x}-{current_y+kernel_size_y}-{current_x+kernel_size_x}'
-                prob = self.dd_wrapper.evaluate_model(im1, iid)
-
-                if self.tag in prob:
-                    prob = prob[self.tag]
-                else:
+                if cached_only and not self.dd_wrapper.is_cached(iid):
                     prob = 0
+                    x_grid.append(np.nan)
+                else:
+                    prob = self.evaluate_window(
+                        current_y,
+                        current_x,
+                        current_y + kernel_size_y,
+                        current_x + kernel_size_x
+                    )
+                    x_grid.append(prob)
 
                 if prob > minimal_percentage:
                     bests.append(
@@ -261,27 +1171,22 @@ class DeepDanbooruObjectRecognitionNode:
                     )
 
                 print(f"{iid}, {prob}")
-                x_dots.append(prob)
+                windows.append((current_y, current_x, current_y + kernel_size_y, current_x + kernel_size_x))
 
                 current_x += step_x
 
-            dots.insert(0, x_dots)
+            grid.append(x_grid)
             current_y += step_y
 
-        with open(f"{self.export_directory}/dots_{self.tag}.json", "w") as _f:
-            _f.write(json.dumps(bests, indent=4))
-
-        dots = np.array(dots)
-
-        # Create heatmap
-        fig, ax = plt.subplots()
-        c = ax.pcolormesh(dots, cmap='gray', vmin=0, vmax=1)
+        # Top to bottom probabilities, kept for the grid store
+        self.grid = np.array(grid, dtype=np.float32)
 
-        fig.colorbar(c, ax=None)
-        fig.canvas.draw()
+        # Per pixel density from the overlapping windows
+        probabilities = self.grid.flatten()
+        self.density = DeepDanbooruDensityMap.accumulate(windows, probabilities)
 
-        image_name = f"{self.export_directory}/heatmap_{self.tag}.png"
-        fig.savefig(image_name, bbox_inches='tight', pad_inches=0)
+        if write_artifacts:
+            self.save_heatmaps(bests)
 
         # Function to delete duplicates entries
         def delete_duplicated(bests, axis="X"):
@@ -395,11 +1300,14 @@ class DeepDanbooruObjectRecognitionNode:
 
             return iterable_bounces
 
-        bests = delete_duplicated(bests, axis="X")
-        bests = delete_duplicated(bests, axis="Y")
+        if box_source == "density":
+            bests = DeepDanbooruDensityMap.boxes(self.density, windows, minimal_percentage)
+        elif merge_duplicates:
+            bests = delete_duplicated(bests, axis="X")
+            bests = delete_duplicated(bests, axis="Y")
 
         c = 0
-        for best in bests:
+        for best in bests if write_artifacts else []:
             c += 1
             self.drawer.title = f"Best_{c}_{self.tag}"
             self.drawer.crop(
@@ -414,22 +1322,39 @@ class DeepDanbooruObjectRecognitionNode:
         print(bests)
         return bests
 
+    def save_heatmaps(self, bests):
+
+        self.artifacts.save_text(f"dots_{self.tag}.json", json.dumps(bests, indent=4))
+        self.artifacts.save_image(f"density_{self.tag}.png", DeepDanbooruDensityMap.preview_image(self.density, self.drawer.source_pil_image))
+
+        # pcolormesh draws the first row at the bottom
+        dots = np.nan_to_num(self.grid)[::-1]
+
+        # Create heatmap
+        fig, ax = plt.subplots()
+        c = ax.pcolormesh(dots, cmap='gray', vmin=0, vmax=1)
+
+        fig.colorbar(c, ax=None)
+        fig.canvas.draw()
+
+        buffer = BytesIO()
+        fig.savefig(buffer, format="png", bbox_inches='tight', pad_inches=0)
+        plt.close(fig)
+        self.artifacts.save_bytes(f"heatmap_{self.tag}.png", buffer.getvalue())
+
 
-    def rect_tag(self, steps = 10, subdivisions = 3, tolerance = 0.05):
+    def rect_tag(self, steps = 10, subdivisions = 3, tolerance = 0.05, budget = None):
 
         # debug
         debug = False
         # Init prob
         print(f"Evaluating: {self.tag}")
 
-        im0 = self.drawer.crop(0, 0, 512, 512)
-        initial_prob = self.dd_wrapper.evaluate_model(im0, "0-0-512-512")
+        initial_prob = self.evaluate_window(0, 0, 512, 512)
 
-        if self.tag not in initial_prob:
+        if not self.dd_wrapper.has_tag(self.tag):
             return None
 
-        initial_prob = initial_prob[self.tag]
-
         current_borders = {
             "top": 0,
             "left": 0,
@@ -489,22 +1414,25 @@ class DeepDanbooruObjectRecognitionNode:
             })
 
             # Evaluate the new regions and determine best
+            windows = [
+                (border["top"], border["left"], border["bottom"], border["right"])
+                for border in borders
+            ]
+            self.evaluate_windows(windows, budget)
+
+            if budget is not None and not all(self.is_window_cached(w) for w in windows):
+                # Out of budget, keep the best region found so far
+                break
+
             for border in borders:
 
-                im1 = self.drawer.crop(
+                prob = self.evaluate_window(
                     border["top"],
                     border["left"],
                     border["bottom"],
                     border["right"]
                 )
 
-                iid = f'{border["top"]}-{border["left"]}-{border["bottom"]}-{border["right"]}'
-                prob = self.dd_wrapper.evaluate_model(im1, iid)
-                if self.tag in prob:
-                    prob = prob[self.tag]
-                else:
-                    prob = 0
-
                 if (prob - best_prob) + tolerance > 0:
 
                     best_status = copy.deepcopy(border)
@@ -549,94 +1477,588 @@ class DeepDanbooruObjectRecognitionNode:
         return [values]
 
 
+class DeepDanbooruExportRetention:
+
+    def __init__(
+        self,
+        root_directory,
+        max_bytes = 0,
+        max_age = 0,
+        max_requests = 0
+    ):
+
+        # A limit of 0 disables that limit
+        self.root_directory = root_directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_requests = max_requests
+
+    @staticmethod
+    def from_options(root_directory):
+
+        return DeepDanbooruExportRetention(
+            root_directory,
+            max_bytes = int(shared.opts.img2txt_retention_max_mb * 1024 * 1024),
+            max_age = int(shared.opts.img2txt_retention_max_days * 24 * 60 * 60),
+            max_requests = int(shared.opts.img2txt_retention_max_requests)
+        )
+
+    @staticmethod
+    def read_manifest(request_directory):
+
+        try:
+            with open(os.path.join(request_directory, DeepDanbooruArtifactStore.manifest_name), "r") as _f:
+                return json.loads(_f.read())
+        except (OSError, ValueError):
+            return None
+
+    def scan(self):
+
+        # One manifest read per request, folders written before manifests existed are walked
+        requests = []
+        for entry in os.scandir(self.root_directory):
+            if not entry.is_dir() or entry.name == DeepDanbooruArtifactStore.objects_name:
+                continue
+
+            manifest = self.read_manifest(entry.path)
+            if manifest is not None:
+                inodes = {key: size for key, size in manifest["files"].values()}
+            else:
+                inodes = {}
+                for directory, _, files in os.walk(entry.path):
+                    for name in files:
+                        stat = os.stat(os.path.join(directory, name))
+                        inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+
+            requests.append((entry.stat().st_mtime, entry.path, inodes))
+
+        return sorted(requests)
+
+    def enforce(self):
+
+        # Disabled by default, eviction deletes request folders written before the upgrade too
+        if not (self.max_bytes or self.max_age or self.max_requests):
+            return 0
+
+        if not os.path.isdir(self.root_directory):
+            return 0
+
+        requests = self.scan()
+
+        # Hard linked artifacts are shared between requests, count each file once
+        owners = {}
+        sizes = {}
+        for _, path, inodes in requests:
+            for inode, size in inodes.items():
+                owners.setdefault(inode, set()).add(path)
+                sizes[inode] = size
+        total_bytes = sum(sizes.values())
+
+        now = time.time()
+        evicted = 0
+        for mtime, path, inodes in requests:
+
+            remaining = len(requests) - evicted
+            if not (
+                (self.max_requests and remaining > self.max_requests) or
+                (self.max_bytes and total_bytes > self.max_bytes) or
+                (self.max_age and now - mtime > self.max_age)
+            ):
+                break
+
+            shutil.rmtree(path, ignore_errors=True)
+            evicted += 1
+
+            for inode in inodes:
+                owners[inode].discard(path)
+                if not owners[inode]:
+                    total_bytes -= sizes[inode]
+
+        if evicted:
+            print(f"Img2Txt: evicted {evicted} old request folders from {self.root_directory}")
+            self.collect_objects()
+
+        return evicted
+
+    def collect_objects(self):
+
+        # Objects no longer linked from any request folder
+        objects_directory = os.path.join(self.root_directory, DeepDanbooruArtifactStore.objects_name)
+        if not os.path.isdir(objects_directory):
+            return
+
+        for directory, _, files in os.walk(objects_directory, topdown=False):
+            for name in files:
+                path = os.path.join(directory, name)
+                if os.stat(path).st_nlink <= 1:
+                    os.remove(path)
+
+            if directory != objects_directory and not os.listdir(directory):
+                os.rmdir(directory)
+
+class DeepDanbooruArtifactStore:
+
+    objects_name = "objects"
+    manifest_name = "manifest.json"
+
+    def __init__(
+        self,
+        root_directory,
+        request_uuid,
+        retention = None
+    ):
+
+        self.root_directory = root_directory
+        self.request_directory = os.path.join(root_directory, request_uuid)
+        self.objects_directory = os.path.join(root_directory, self.objects_name)
+        self.retention = retention
+        self.created = False
+        # name -> [content key, size], read by retention instead of listing the folder
+        self.files = {}
+
+    def ensure_request_directory(self):
+
+        if not self.created:
+            os.makedirs(self.request_directory, exist_ok=True)
+            self.created = True
+
+            if self.retention is not None:
+                self.retention.enforce()
+
+        return self.request_directory
+
+    def save_bytes(self, name, data):
+
+        # Identical content is stored once under its hash and hard linked into the request folder.
+        # The request folder comes first, creating it may collect unlinked objects
+        request_directory = self.ensure_request_directory()
+
+        digest = hashlib.sha1(data).hexdigest()
+        object_path = os.path.join(self.objects_directory, digest[:2], f"{digest}{os.path.splitext(name)[1]}")
+
+        target_path = os.path.join(request_directory, name)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+
+        linked = False
+        for _ in range(3):
+            if not os.path.exists(object_path):
+                self.write_file(object_path, data)
+            try:
+                os.link(object_path, target_path)
+                linked = True
+                break
+            except FileNotFoundError:
+                # Collected by the retention of another request in between, written again
+                continue
+            except OSError:
+                break
+
+        if not linked:
+            self.write_file(target_path, data)
+
+        self.files[name] = [os.path.basename(object_path) if linked else f"{os.path.basename(request_directory)}/{name}", len(data)]
+        self.write_file(
+            os.path.join(request_directory, self.manifest_name),
+            json.dumps({"files": self.files}).encode("utf-8")
+        )
+
+        return target_path
+
+    @staticmethod
+    def write_file(path, data):
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as _f:
+            _f.write(data)
+        os.replace(tmp_path, path)
+
+    def save_text(self, name, text):
+        return self.save_bytes(name, text.encode("utf-8"))
+
+    def save_image(self, name, pil_image):
+
+        buffer = BytesIO()
+        pil_image.save(buffer, format="PNG")
+        return self.save_bytes(name, buffer.getvalue())
+
+class DeepDanbooruGridStore:
+
+    grid_name = "grid.npy"
+    meta_name = "grid.json"
+
+    @staticmethod
+    def image_sha1(pil_image):
+
+        rgb = pil_image.convert("RGB")
+        digest = hashlib.sha1(f"{rgb.size[0]}x{rgb.size[1]}".encode())
+        digest.update(rgb.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def save(artifacts, tags, grids, geometry, image_sha1, image_dhash=None):
+
+        # (tags, rows, cols) float16 in .npy format: a small header followed by
+        # the raw array, so it can be memory-mapped without parsing
+        if grids:
+            grid = np.stack(grids).astype(np.float16)
+        else:
+            grid = np.zeros((0, 0, 0), dtype=np.float16)
+
+        buffer = BytesIO()
+        np.save(buffer, grid)
+        artifacts.save_bytes(DeepDanbooruGridStore.grid_name, buffer.getvalue())
+
+        meta = {
+            "tags": list(tags),
+            "shape": list(grid.shape),
+            "dtype": "float16",
+            "geometry": geometry,
+            "image_sha1": image_sha1,
+            "image_dhash": f"{image_dhash:016x}" if image_dhash is not None else None,
+            "created": time.time()
+        }
+        artifacts.save_text(DeepDanbooruGridStore.meta_name, json.dumps(meta))
+
+        return meta
+
+    @staticmethod
+    def load(export_directory):
+
+        with open(os.path.join(export_directory, DeepDanbooruGridStore.meta_name), "r") as _f:
+            meta = json.loads(_f.read())
+
+        grid = np.load(os.path.join(export_directory, DeepDanbooruGridStore.grid_name), mmap_mode="r")
+        return meta, grid
+
+    @staticmethod
+    def density_image(export_directory, tag, pil_image):
+
+        # Full resolution density map of a stored tag, rebuilt from its window grid on demand
+        meta, grid = DeepDanbooruGridStore.load(export_directory)
+        if meta["image_sha1"] != DeepDanbooruGridStore.image_sha1(pil_image):
+            raise ValueError(f"The grid in {export_directory} was not computed from this image")
+
+        geometry = meta["geometry"]
+        windows = [
+            (top, left, top + geometry["kernel_y"], left + geometry["kernel_x"])
+            for top in range(0, geometry["rows"] * geometry["step_y"], geometry["step_y"])
+            for left in range(0, geometry["cols"] * geometry["step_x"], geometry["step_x"])
+        ]
+        probabilities = np.asarray(grid[meta["tags"].index(tag)], dtype=np.float32).flatten()
+
+        density = DeepDanbooruDensityMap.accumulate(windows, probabilities, geometry["space"])
+        return DeepDanbooruDensityMap.to_image(density, pil_image)
+
+    @staticmethod
+    def iter_requests(root_directory=None):
+
+        # Bulk access over every stored request: yields (request uuid, meta, memory-mapped grid)
+        if root_directory is None:
+            root_directory = os.path.join(shared.opts.outdir_extras_samples, "ddor")
+
+        for request_uuid in sorted(os.listdir(root_directory)):
+            if request_uuid == DeepDanbooruArtifactStore.objects_name:
+                continue
+
+            request_directory = os.path.join(root_directory, request_uuid)
+            if not os.path.exists(os.path.join(request_directory, DeepDanbooruGridStore.meta_name)):
+                continue
+
+            meta, grid = DeepDanbooruGridStore.load(request_directory)
+            yield request_uuid, meta, grid
+
 class DeepDanbooruObjectRecognitionUtil:
 
     def __init__(
         self,
         pil_image,
         minimal_threshold = 0.5,
-        max_display = 10
+        max_display = 10,
+        hash_index = None,
+        dd_wrapper = None,
+        artifacts = None
     ):
 
-        self.dd_wrapper = DeepDanbooruWrapper()
+        self.dd_wrapper = dd_wrapper if dd_wrapper is not None else DeepDanbooruWrapper()
 
         self.minimal_threshold = minimal_threshold
         self.pil_image = pil_image
         self.max_display = int(max_display)
         self.request_uuid = str(uuid.uuid1())
 
-        self.export_directory = os.path.join(shared.opts.outdir_extras_samples, "ddor")
-        if not os.path.exists(self.export_directory):
-            os.makedirs(self.export_directory)
+        if hash_index is not None and not DeepDanbooruHashIndex.is_informative(pil_image):
+            hash_index = None
+
+        self.hash_index = hash_index
+        self.image_hash = DeepDanbooruHashIndex.dhash(pil_image) if hash_index is not None else None
+        self.image_thumbnail = DeepDanbooruHashIndex.thumbnail(pil_image) if hash_index is not None else None
+        self.reused = []
+        self.skipped = []
+        self.budget = None
+        self.drawer = None
+
+        # The request folder is only created once something is written to it
+        if artifacts is None:
+            root_directory = os.path.join(shared.opts.outdir_extras_samples, "ddor")
+            artifacts = DeepDanbooruArtifactStore(
+                root_directory,
+                self.request_uuid,
+                DeepDanbooruExportRetention.from_options(root_directory)
+            )
+        self.artifacts = artifacts
+        self.export_directory = self.artifacts.request_directory
 
-        self.export_directory = os.path.join(self.export_directory, self.request_uuid)
-        if not os.path.exists(self.export_directory):
-            os.makedirs(self.export_directory)
+    def find_markers(self, key):
 
-    def create_heatmaps_util(self, tags, kernel_x, kernel_y, step_x, step_y, minimal_percentage):
+        if self.hash_index is None:
+            return None
 
-        self.drawer = DeepDanbooruObjectDrawer(
-            self.pil_image.copy(),
-            f"Result-{time.time()}",
-            self.export_directory
+        figures, distance = self.hash_index.find_markers(self.image_hash, self.image_thumbnail, key)
+        if figures is not None:
+            self.reused.append(f"{key.split(':')[1]} (distance {distance})")
+
+        return figures
+
+    def store_markers(self, key, figures):
+
+        if self.hash_index is not None:
+            self.hash_index.store_markers(self.image_hash, self.image_thumbnail, key, figures or [])
+
+    def status(self, message):
+
+        if self.reused:
+            message += f" | reused near-duplicate results for: {', '.join(self.reused)}"
+
+        if self.skipped:
+            message += f" | skipped absent tags: {', '.join(f'{tag} ({prob:.3f})' for tag, prob in self.skipped)}"
+
+        if self.budget is not None and self.budget.exhausted():
+            message += f" | budget reached after {self.budget.evaluations} window evaluations, best so far shown"
+
+        if self.hash_index is not None:
+            message += f" | {self.hash_index.stats()}"
+
+        return message
+
+    def create_budget(self, deadline, max_evaluations):
+
+        if deadline or max_evaluations:
+            self.budget = DeepDanbooruLocalizationBudget(deadline, max_evaluations)
+        else:
+            self.budget = None
+
+        return self.budget
+
+    def prescreen(self, tags, prescreen_threshold, rank=False):
+
+        # One full image pass scores every requested tag, absent tags are skipped
+        # and the others are localized from the most to the least likely
+        tag_pairs = [(tag, tag.strip().replace(" ", "_")) for tag in tags.split(",") if tag.strip()]
+        if not tag_pairs or not (prescreen_threshold or rank):
+            return tag_pairs
+
+        iid = "0-0-512-512"
+        y = self.dd_wrapper.evaluate_vector(
+            None if self.dd_wrapper.is_cached(iid) else self.drawer.crop(0, 0, 512, 512),
+            iid
         )
 
-        for tag in tags.split(","):
+        scored = sorted(
+            [(self.dd_wrapper.tag_probability(y, node_tag), tag, node_tag) for tag, node_tag in tag_pairs],
+            key=lambda x: -x[0]
+        )
 
-            if not tag.strip():
+        kept = []
+        for prob, tag, node_tag in scored:
+            if prescreen_threshold and prob < prescreen_threshold:
+                self.skipped.append((node_tag, float(prob)))
                 continue
-
-            dd_node = DeepDanbooruObjectRecognitionNode(
-                self.dd_wrapper,
-                self.pil_image,
-                tag.strip().replace(" ", "_"),
-                export_directory = self.export_directory
+            kept.append((tag, node_tag))
+
+        return kept
+
+    def sweep_windows(self, node_tags, kernel_x, kernel_y, step_x, step_y):
+
+        # Coarse grid first, then the neighbours of the most promising windows, until the budget runs out
+        helper = DeepDanbooruObjectRecognitionNode(self.dd_wrapper, self.pil_image, "", self.artifacts, self.drawer)
+        indices = [self.dd_wrapper.tag_index[tag] for tag in node_tags if self.dd_wrapper.has_tag(tag)]
+        if not indices:
+            return
+
+        positions = {}
+        for row, top in enumerate(range(0, 512 - kernel_y, step_y)):
+            for col, left in enumerate(range(0, 512 - kernel_x, step_x)):
+                positions[(row, col)] = (top, left, top + kernel_y, left + kernel_x)
+
+        # Priority of a window: best score among its evaluated neighbours
+        priorities = {p: -1.0 for p in positions if p[0] % 2 or p[1] % 2}
+        heap = [(1.0, row, col) for row, col in priorities]
+        heapq.heapify(heap)
+
+        def evaluated(chunk):
+            # Raises the priority of the neighbours of the windows just evaluated
+            for row, col in chunk:
+                window = positions[(row, col)]
+                if not helper.is_window_cached(window):
+                    continue
+                score = float(np.max(self.dd_wrapper.cache['{}-{}-{}-{}'.format(*window)][indices]))
+                for neighbour in ((row + i, col + j) for i in (-1, 0, 1) for j in (-1, 0, 1)):
+                    if priorities.get(neighbour, score) < score:
+                        priorities[neighbour] = score
+                        heapq.heappush(heap, (-score, *neighbour))
+
+        coarse = [p for p in positions if p[0] % 2 == 0 and p[1] % 2 == 0]
+        helper.evaluate_windows([positions[p] for p in coarse], self.budget)
+        evaluated(coarse)
+
+        capacity = self.dd_wrapper.batch_capacity()
+        while heap and not self.budget.exhausted():
+            chunk = []
+            while heap and len(chunk) < capacity:
+                priority, row, col = heapq.heappop(heap)
+                # Entries superseded by a higher priority are skipped
+                if priorities.get((row, col)) == -priority:
+                    del priorities[(row, col)]
+                    chunk.append((row, col))
+
+            helper.evaluate_windows([positions[p] for p in chunk], self.budget)
+            evaluated(chunk)
+
+    def create_heatmaps_util(self, tags, kernel_x, kernel_y, step_x, step_y, minimal_percentage, merge_duplicates=True,
+                             deadline=0, max_evaluations=0, prescreen_threshold=0, box_source="windows", preview=False):
+
+        # A preview only recomputes boxes from the retained probabilities, it evaluates
+        # and writes nothing and reuses the drawer of the sweep when one is set
+        if not preview or self.drawer is None:
+            self.drawer = DeepDanbooruObjectDrawer(
+                self.pil_image.copy(),
+                f"Result-{time.time()}",
+                self.artifacts
             )
+        markers = []
+        grid_tags = []
+        grids = []
+
+        budget = None if preview else self.create_budget(deadline, max_evaluations)
+        if preview and not self.dd_wrapper.is_cached("0-0-512-512"):
+            prescreen_threshold = 0
+        tag_pairs = self.prescreen(tags, prescreen_threshold, rank=budget is not None)
+        if budget is not None and tag_pairs:
+            self.sweep_windows([node_tag for _, node_tag in tag_pairs], kernel_x, kernel_y, step_x, step_y)
+
+        for tag, node_tag in tag_pairs:
+
+            key = f"heatmap:{node_tag}:{kernel_x}:{kernel_y}:{step_x}:{step_y}:{minimal_percentage}:{int(merge_duplicates)}:{box_source}"
+
+            figures = self.find_markers(key)
+            if figures is None:
+
+                dd_node = DeepDanbooruObjectRecognitionNode(
+                    self.dd_wrapper,
+                    self.pil_image,
+                    node_tag,
+                    artifacts = self.artifacts,
+                    drawer = self.drawer
+                )
 
-            figures = dd_node.create_heatmaps(
-                kernel_x,
-                kernel_y,
-                step_x,
-                step_y,
-                minimal_percentage
-            )
+                figures = dd_node.create_heatmaps(
+                    kernel_x,
+                    kernel_y,
+                    step_x,
+                    step_y,
+                    minimal_percentage,
+                    merge_duplicates,
+                    budget,
+                    box_source,
+                    cached_only=preview,
+                    write_artifacts=not preview
+                )
+                if not preview and (budget is None or not budget.exhausted()):
+                    self.store_markers(key, figures)
+
+                grid_tags.append(node_tag)
+                grids.append(dd_node.grid)
 
             if not figures:
                 continue
 
             for figure in figures:
-                self.drawer.draw_rect(figure, f"{tag.strip().replace('_', ' ')}:\n{figure['prob']:.3f}")
+                markers.append(dict(figure, tag=node_tag, label=f"{tag.strip().replace('_', ' ')}:\n{figure['prob']:.3f}"))
+
+        if grids and not preview:
+            DeepDanbooruGridStore.save(
+                self.artifacts,
+                grid_tags,
+                grids,
+                {
+                    "space": 512,
+                    "kernel_x": kernel_x,
+                    "kernel_y": kernel_y,
+                    "step_x": step_x,
+                    "step_y": step_y,
+                    "rows": int(grids[0].shape[0]),
+                    "cols": int(grids[0].shape[1]) if grids[0].ndim == 2 else 0
+                },
+                DeepDanbooruGridStore.image_sha1(self.pil_image),
+                self.image_hash
+            )
 
-        self.drawer.crop(0,0,512,512, export=True, image_to_use="RECT")
-        return self.drawer.rect_pil_image
+        return markers
 
-    def create_rects(self, tags, steps, subdivisions, tolerance):
+    def create_rects(self, tags, steps, subdivisions, tolerance, deadline=0, max_evaluations=0, prescreen_threshold=0):
 
         self.drawer = DeepDanbooruObjectDrawer(
             self.pil_image.copy(),
             f"Result-{time.time()}",
-            self.export_directory
+            self.artifacts
         )
+        markers = []
 
-        for tag in tags.split(","):
+        budget = self.create_budget(deadline, max_evaluations)
+        tag_pairs = self.prescreen(tags, prescreen_threshold, rank=budget is not None)
 
-            if not tag.strip():
-                continue
+        for tag, node_tag in tag_pairs:
 
-            dd_node = DeepDanbooruObjectRecognitionNode(
-                self.dd_wrapper,
-                self.pil_image,
-                tag.strip().replace(" ", "_"),
-                export_directory = self.export_directory
-            )
+            key = f"rect:{node_tag}:{steps}:{subdivisions}:{tolerance}"
+
+            figures = self.find_markers(key)
+            if figures is None:
+
+                dd_node = DeepDanbooruObjectRecognitionNode(
+                    self.dd_wrapper,
+                    self.pil_image,
+                    node_tag,
+                    artifacts = self.artifacts,
+                    drawer = self.drawer
+                )
 
-            figures = dd_node.rect_tag(steps, subdivisions, tolerance)
+                figures = dd_node.rect_tag(steps, subdivisions, tolerance, budget)
+                if budget is None or not budget.exhausted():
+                    self.store_markers(key, figures)
 
             if not figures:
                 continue
 
             for figure in figures:
-                self.drawer.draw_rect(figure, f"{tag.strip().replace('_', ' ')}:{figure['prob']}")
+                markers.append(dict(figure, tag=node_tag, label=f"{tag.strip().replace('_', ' ')}:{figure['prob']}"))
+
+        return markers
+
+    def annotate_markers(self, markers):
+
+        # Boxes are drawn by the browser on top of the 512 preview
+        annotations = [
+            ((marker["left"], marker["top"], marker["right"], marker["bottom"]), marker["label"])
+            for marker in markers
+        ]
+        return self.drawer.pil_image, annotations
+
+    def export_markers(self, markers):
+
+        for marker in markers:
+            self.drawer.draw_rect(marker, marker["label"])
 
         self.drawer.crop(0,0,512,512, export=True, image_to_use="RECT")
         return self.drawer.rect_pil_image
@@ -646,16 +2068,558 @@ class DeepDanbooruObjectRecognitionUtil:
 
         tag_probs = {}
 
-        print("Extracting all tags")
-        model_tags = self.dd_wrapper.evaluate_model(self.pil_image, "extract", self.minimal_threshold)
+        model_tags = None
+        if self.hash_index is not None:
+            model_tags, distance = self.hash_index.find_tags(self.image_hash, self.image_thumbnail, self.minimal_threshold)
+            if model_tags is not None:
+                print(f"Reusing tags of a near-duplicate image (distance {distance})")
+                self.reused.append(f"tags (distance {distance})")
+
+        if model_tags is None:
+            print("Extracting all tags")
+            model_tags = self.dd_wrapper.evaluate_model(self.pil_image, "extract", self.minimal_threshold)
+            if self.hash_index is not None:
+                self.hash_index.store_tags(self.image_hash, self.image_thumbnail, self.minimal_threshold, model_tags)
+
         model_tags = dict(sorted(model_tags.items(), key=lambda x: -x[1])[0:self.max_display])
         print(json.dumps(str(model_tags), indent=4))
         model_tags = list(model_tags.keys())
 
         return model_tags
 
+class DeepDanbooruMetadataImage:
+
+    # Stands in for a PIL image in run_pnginfo, which only reads info and size
+    def __init__(self, info, size):
+
+        self.info = info
+        self.size = size
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+class DeepDanbooruMetadataReader:
+
+    # Same limit Pillow applies to decompressed text chunks
+    max_text = 1024 * 1024
+    max_entries = 4096
+    extensions = (".png", ".jpg", ".jpeg", ".webp")
+    # Chunks PngImagePlugin turns into info entries
+    png_chunks = (b"IHDR", b"tEXt", b"zTXt", b"iTXt", b"tRNS", b"eXIf", b"gAMA", b"cHRM", b"sRGB", b"pHYs", b"acTL", b"fcTL")
+
+    # sha1 of the file -> (geninfo, info), (path, size, mtime) -> sha1
+    cache = {}
+    file_hashes = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def remember(entries, key, value):
+
+        with DeepDanbooruMetadataReader.lock:
+            entries[key] = value
+            while len(entries) > DeepDanbooruMetadataReader.max_entries:
+                entries.pop(next(iter(entries)))
+
+    @staticmethod
+    def decompress(data):
+
+        decompressor = zlib.decompressobj()
+        text = decompressor.decompress(data, DeepDanbooruMetadataReader.max_text)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed text chunk too large")
+
+        return text
+
+    @staticmethod
+    def read_png(fp):
+
+        # Same info as a loaded PngImagePlugin image: every chunk up to IEND, or up to
+        # the second frame of an animation, pixel data is skipped without reading it
+        info = {}
+        size = (0, 0)
+        color_type = 0
+        animated = False
+        idat_seen = False
+        fp.seek(8)
+
+        while True:
+            header = fp.read(8)
+            if len(header) < 8:
+                break
+
+            length, chunk = struct.unpack(">I4s", header)
+            if chunk == b"IEND" or (chunk == b"fcTL" and animated and idat_seen):
+                break
+
+            if chunk == b"IDAT" and not idat_seen:
+                idat_seen = True
+                if animated and "bbox" not in info:
+                    info["default_image"] = True
+
+            if chunk not in DeepDanbooruMetadataReader.png_chunks:
+                fp.seek(length + 4, 1)
+                continue
+
+            data = fp.read(length)
+            fp.seek(4, 1)
+
+            if chunk == b"IHDR":
+                size = struct.unpack(">II", data[:8])
+                color_type = data[9]
+                if data[12]:
+                    info["interlace"] = 1
+            elif chunk == b"tEXt":
+                key, value = data.split(b"\0", 1) if b"\0" in data else (data, b"")
+                if key:
+                    key = key.decode("latin-1")
+                    info[key] = value if key == "exif" else value.decode("latin-1", "replace")
+            elif chunk == b"zTXt":
+                key, value = data.split(b"\0", 1) if b"\0" in data else (data, b"")
+                try:
+                    value = DeepDanbooruMetadataReader.decompress(value[1:])
+                except zlib.error:
+                    value = b""
+                if key:
+                    info[key.decode("latin-1")] = value.decode("latin-1", "replace")
+            elif chunk == b"iTXt":
+                try:
+                    key, value = data.split(b"\0", 1)
+                    compressed, method, value = value[0], value[1], value[2:]
+                    _, _, value = value.split(b"\0", 2)
+                    if compressed:
+                        if method != 0:
+                            continue
+                        value = DeepDanbooruMetadataReader.decompress(value)
+                    if key == b"XML:com.adobe.xmp":
+                        info["xmp"] = value
+                    info[key.decode("latin-1")] = value.decode("utf-8")
+                except (ValueError, IndexError, zlib.error, UnicodeError):
+                    continue
+            elif chunk == b"tRNS":
+                if color_type == 3:
+                    # A single fully transparent palette entry is stored as its index
+                    if re.match(rb"^\xff*\x00\xff*$", data):
+                        info["transparency"] = data.find(b"\0")
+                    else:
+                        info["transparency"] = data
+                elif color_type == 0:
+                    info["transparency"] = struct.unpack(">H", data[:2])[0]
+                elif color_type == 2:
+                    info["transparency"] = struct.unpack(">HHH", data[:6])
+            elif chunk == b"eXIf":
+                info["exif"] = b"Exif\x00\x00" + data
+            elif chunk == b"gAMA":
+                info["gamma"] = struct.unpack(">I", data)[0] / 100000.0
+            elif chunk == b"cHRM":
+                info["chromaticity"] = tuple(value / 100000.0 for value in struct.unpack(">8I", data[:32]))
+            elif chunk == b"sRGB":
+                info["srgb"] = data[0]
+            elif chunk == b"pHYs":
+                px, py, unit = struct.unpack(">IIB", data)
+                if unit == 1:
+                    info["dpi"] = px * 0.0254, py * 0.0254
+                elif unit == 0:
+                    info["aspect"] = px, py
+            elif chunk == b"acTL":
+                frames, loop = struct.unpack(">II", data[:8])
+                if 0 < frames <= 0x80000000 and not animated:
+                    animated = True
+                    info["loop"] = loop
+            elif chunk == b"fcTL":
+                width, height, px, py, delay_num, delay_den = struct.unpack(">IIIIHH", data[4:24])
+                info["bbox"] = (px, py, px + width, py + height)
+                info["duration"] = float(delay_num) / float(delay_den or 100) * 1000
+                info["disposal"] = data[24]
+                info["blend"] = data[25]
+
+        return DeepDanbooruMetadataImage(info, size)
+
+    @staticmethod
+    def read_jpeg(fp):
+
+        info = {}
+        size = (0, 0)
+        fp.seek(2)
+
+        while True:
+            marker = fp.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                break
+
+            code = marker[1]
+            if code == 0xFF:
+                # Fill byte before the marker
+                fp.seek(-1, 1)
+                continue
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                continue
+            # Entropy coded data follows the scan header
+            if code in (0xD9, 0xDA):
+                break
+
+            length = struct.unpack(">H", fp.read(2))[0]
+            is_frame = 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC)
+            if not is_frame and code not in (0xE1, 0xEE, 0xFE):
+                fp.seek(length - 2, 1)
+                continue
+
+            data = fp.read(length - 2)
+
+            # Keys as JpegImagePlugin stores them
+            if is_frame:
+                height, width = struct.unpack(">HH", data[1:5])
+                size = (width, height)
+            elif code == 0xE1 and data[:6] == b"Exif\0\0":
+                info.setdefault("exif", data)
+            elif code == 0xE1 and data[:29] == b"http://ns.adobe.com/xap/1.0/\x00":
+                info["xmp"] = data.split(b"\x00", 1)[1]
+            elif code == 0xEE and data[:5] == b"Adobe":
+                info["adobe"] = struct.unpack(">H", data[5:7])[0]
+                if len(data) > 11:
+                    info["adobe_transform"] = data[11]
+            elif code == 0xFE:
+                info["comment"] = data
+
+        return DeepDanbooruMetadataImage(info, size)
+
+    @staticmethod
+    def read_webp(fp):
+
+        info = {}
+        size = (0, 0)
+        fp.seek(12)
+
+        while True:
+            header = fp.read(8)
+            if len(header) < 8:
+                break
+
+            chunk, length = struct.unpack("<4sI", header)
+            padded = length + (length & 1)
+
+            if chunk in (b"EXIF", b"XMP "):
+                data = fp.read(length)
+                fp.seek(padded - length, 1)
+                info["exif" if chunk == b"EXIF" else "xmp"] = data
+                continue
+
+            if chunk not in (b"VP8X", b"VP8 ", b"VP8L"):
+                fp.seek(padded, 1)
+                continue
+
+            # Only the bitstream header holds the canvas size
+            data = fp.read(min(length, 10))
+            fp.seek(padded - len(data), 1)
+
+            if size != (0, 0):
+                continue
+            if chunk == b"VP8X":
+                size = (int.from_bytes(data[4:7], "little") + 1, int.from_bytes(data[7:10], "little") + 1)
+            elif chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", data[6:10])
+                size = (width & 0x3FFF, height & 0x3FFF)
+            else:
+                bits = int.from_bytes(data[1:5], "little")
+                size = ((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+
+        return DeepDanbooruMetadataImage(info, size)
+
+    @staticmethod
+    def read_image(fp):
+
+        signature = fp.read(12)
+        if signature[:8] == b"\x89PNG\r\n\x1a\n":
+            return DeepDanbooruMetadataReader.read_png(fp)
+        if signature[:2] == b"\xff\xd8":
+            return DeepDanbooruMetadataReader.read_jpeg(fp)
+        if signature[:4] == b"RIFF" and signature[8:12] == b"WEBP":
+            return DeepDanbooruMetadataReader.read_webp(fp)
+
+        # Other formats, Image.open only parses the header
+        fp.seek(0)
+        with Image.open(fp) as im:
+            return DeepDanbooruMetadataImage(dict(im.info), im.size)
+
+    @staticmethod
+    def file_sha1(path):
+
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = DeepDanbooruMetadataReader.file_hashes.get(key)
+
+        if digest is None:
+            sha1 = hashlib.sha1()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    sha1.update(block)
+            digest = sha1.hexdigest()
+            DeepDanbooruMetadataReader.remember(DeepDanbooruMetadataReader.file_hashes, key, digest)
+
+        return digest
+
+    @staticmethod
+    def pnginfo(source):
+
+        # Returns the geninfo and info of run_pnginfo for a PIL image, a path or the file bytes
+        if isinstance(source, Image.Image):
+            _, geninfo, info = run_pnginfo(source)
+            return geninfo, info
+
+        if isinstance(source, bytes):
+            digest = hashlib.sha1(source).hexdigest()
+            open_source = lambda: BytesIO(source)
+        else:
+            digest = DeepDanbooruMetadataReader.file_sha1(source)
+            open_source = lambda: open(source, "rb")
+
+        result = DeepDanbooruMetadataReader.cache.get(digest)
+        if result is None:
+            with open_source() as fp:
+                image = DeepDanbooruMetadataReader.read_image(fp)
+
+            _, geninfo, info = run_pnginfo(image)
+            result = (geninfo, info)
+            DeepDanbooruMetadataReader.remember(DeepDanbooruMetadataReader.cache, digest, result)
+
+        return result
+
+    @staticmethod
+    def iter_directory(directory, recursive=True):
+
+        # Headless batch, yields (path, geninfo, info) without decoding any pixels
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+
+            for name in sorted(files):
+                if not name.lower().endswith(DeepDanbooruMetadataReader.extensions):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    geninfo, info = DeepDanbooruMetadataReader.pnginfo(path)
+                except (OSError, ValueError, struct.error, zlib.error) as e:
+                    print(f"Could not read metadata from {path}: {e}")
+                    continue
+
+                yield path, geninfo, info
+
+            if not recursive:
+                break
+
+class Img2TxtGenerator:
+
+    def __init__(
+        self,
+        width=512,
+        height=512,
+        seed=-1,
+        batch_count=1,
+        batch_size=1,
+        steps=20,
+        sampler_name="DPM++ 2M Karras",
+        cfg_scale=7,
+        negative_prompt=""
+    ):
+
+        self.width = int(width)
+        self.height = int(height)
+        self.seed = int(seed)
+        self.batch_count = max(1, int(batch_count))
+        self.batch_size = max(1, int(batch_size))
+        self.steps = steps
+        self.sampler_name = sampler_name
+        self.cfg_scale = cfg_scale
+        self.negative_prompt = negative_prompt
+
+    @staticmethod
+    def tag_subset_prompts(tags, variants=1):
+
+        # Tags come sorted by probability, each variant drops more of the weakest ones
+        tag_list = [tag.strip() for tag in tags.split(",") if tag.strip()]
+        variants = max(1, int(variants))
+
+        prompts = []
+        for i in range(variants):
+            count = max(1, round(len(tag_list) * (variants - i) / variants))
+            prompt = ", ".join(tag_list[:count])
+            if prompt not in prompts:
+                prompts.append(prompt)
+
+        return prompts or [tags]
+
+    def create_processing(self, prompts, request=None):
+
+        # All variants share one batch so N candidates cost a single sampler run
+        batch_size = max(self.batch_size, len(prompts)) if len(prompts) > 1 else self.batch_size
+        total = batch_size * self.batch_count
+        all_prompts = [prompts[i % len(prompts)] for i in range(total)]
+
+        p = StableDiffusionProcessingTxt2Img(
+            sd_model=shared.sd_model,
+            outpath_samples=shared.opts.outdir_samples or shared.opts.outdir_txt2img_samples,
+            outpath_grids=shared.opts.outdir_grids or shared.opts.outdir_txt2img_grids,
+            prompt=all_prompts if len(prompts) > 1 else prompts[0],
+            negative_prompt=self.negative_prompt,
+            seed=self.seed,
+            sampler_name=self.sampler_name,
+            batch_size=batch_size,
+            n_iter=self.batch_count,
+            steps=self.steps,
+            cfg_scale=self.cfg_scale,
+            width=self.width,
+            height=self.height,
+        )
+
+        p.scripts = None
+        if request is not None:
+            p.user = request.username
+
+        return p
+
+    def generate(self, tags, variants=1, request=None):
+
+        prompts = self.tag_subset_prompts(tags, variants)
+        p = self.create_processing(prompts, request)
+
+        shared.state.begin(job="img2txt")
+        try:
+            with closing(p):
+                processed = processing.process_images(p)
+        finally:
+            shared.state.end()
+            shared.total_tqdm.clear()
+
+        return processed
+
+class DeepDanbooruFrameInterrogator:
+
+    def __init__(
+        self,
+        dd_wrapper,
+        minimal_threshold = 0.5,
+        max_display = 10,
+        difference_threshold = 0.04
+    ):
+
+        self.dd_wrapper = dd_wrapper
+        self.minimal_threshold = minimal_threshold
+        self.max_display = int(max_display)
+        self.difference_threshold = difference_threshold
+
+        self.frames = 0
+        self.keyframes = 0
+        self.sums = None
+        self.segments = []
+
+    @staticmethod
+    def iter_frames(path):
+
+        # Frames are decoded one at a time, the clip is never held in memory
+        if os.path.splitext(path)[1].lower() in (".gif", ".webp", ".png", ".apng"):
+            with Image.open(path) as im:
+                for frame in ImageSequence.Iterator(im):
+                    yield frame.convert("RGB")
+            return
+
+        import cv2
+
+        capture = cv2.VideoCapture(path)
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        finally:
+            capture.release()
+
+    @staticmethod
+    def thumbnail(pil_image):
+        small = pil_image.convert("L").resize((64, 64), Image.BILINEAR, reducing_gap=2.0)
+        return np.asarray(small, dtype=np.float32) / 255
+
+    def top_tags(self, y):
+
+        tags = self.dd_wrapper.probabilities_to_tags(y, self.minimal_threshold)
+        return [tag for tag, _ in sorted(tags.items(), key=lambda x: -x[1])[0:self.max_display]]
+
+    def evaluate(self, records):
+
+        # Keyframes without a result yet go through the classifier in one batch
+        pending = [record for record in records if record["vector"] is None]
+        if not pending:
+            return
+
+        outputs = self.dd_wrapper.evaluate_batch(
+            [record["image"] for record in pending],
+            ["" for _ in pending]
+        )
+        for record, y in zip(pending, outputs):
+            record["vector"] = y
+            record["image"] = None
+
+    def finalize(self, record):
+
+        # Skipped frames inherit the result of their keyframe
+        weight = record["end"] - record["start"] + 1
+        if self.sums is None:
+            self.sums = np.zeros_like(record["vector"], dtype=np.float64)
+        self.sums += record["vector"] * weight
+
+        tags = self.top_tags(record["vector"])
+        if self.segments and self.segments[-1]["tags"] == tags:
+            self.segments[-1]["end"] = record["end"]
+        else:
+            self.segments.append({"start": record["start"], "end": record["end"], "tags": tags})
+
+    def interrogate(self, path):
+
+        capacity = self.dd_wrapper.batch_capacity()
+        records = []
+        key_thumbnail = None
+
+        for index, frame in enumerate(self.iter_frames(path)):
+            self.frames += 1
+            thumbnail = self.thumbnail(frame)
+
+            if key_thumbnail is not None and np.abs(thumbnail - key_thumbnail).mean() < self.difference_threshold:
+                records[-1]["end"] = index
+                continue
+
+            key_thumbnail = thumbnail
+            self.keyframes += 1
+            records.append({"start": index, "end": index, "image": frame, "vector": None})
+
+            if sum(record["vector"] is None for record in records) >= capacity:
+                self.evaluate(records)
+
+            # Every record but the last one is closed, finalize them once evaluated
+            while len(records) > 1 and records[0]["vector"] is not None:
+                self.finalize(records.pop(0))
+
+        self.evaluate(records)
+        for record in records:
+            self.finalize(record)
+
+        return self.aggregated_tags(), self.segments
+
+    def aggregated_tags(self):
+
+        if self.sums is None:
+            return []
+
+        return self.top_tags(self.sums / self.frames)
+
 class DeepDanbooruObjectRecognitionScript():
 
+    # Probability vectors kept for the current image, about 36 KB each with the full tag list
+    retained_windows = 1024
+
     def __init__(self):
 
         self.source_image = None
@@ -672,6 +2636,66 @@ class DeepDanbooruObjectRecognitionScript():
         self.seed_ui = None
         self.sourceimage_geninfo = None
         self.newimage_geninfo = None
+        self.hash_index = None
+        self.retained_sha1 = None
+        self.retained_wrapper = None
+        self.retained_drawer = None
+        # The script object is shared by every session
+        self.retained_lock = threading.Lock()
+
+    def get_wrapper(self, source_image_PIL):
+
+        # Keeps the probabilities of the current source image, so post-processing
+        # changes and repeated sweeps only evaluate windows not seen before
+        image_sha1 = DeepDanbooruGridStore.image_sha1(source_image_PIL)
+        with self.retained_lock:
+            if image_sha1 != self.retained_sha1:
+                self.retained_sha1 = image_sha1
+                self.retained_wrapper = DeepDanbooruWrapper()
+                self.retained_drawer = None
+            else:
+                # Other kernels and steps on the same image keep adding windows
+                self.retained_wrapper.trim_cache(self.retained_windows)
+
+            return self.retained_wrapper
+
+    def retain_drawer(self, dd_wrapper, drawer):
+
+        # Another session may have moved on to another image since the sweep started
+        with self.retained_lock:
+            if dd_wrapper is self.retained_wrapper:
+                self.retained_drawer = drawer
+
+    def retained(self, source_image_PIL):
+
+        # Wrapper and drawer of the same image, taken together
+        if not source_image_PIL:
+            return None, None
+
+        image_sha1 = DeepDanbooruGridStore.image_sha1(source_image_PIL)
+        with self.retained_lock:
+            if self.retained_wrapper is None or image_sha1 != self.retained_sha1:
+                return None, None
+
+            return self.retained_wrapper, self.retained_drawer
+
+    def is_retained(self, source_image_PIL, image_id):
+
+        dd_wrapper, _ = self.retained(source_image_PIL)
+        return dd_wrapper is not None and dd_wrapper.is_cached(image_id)
+
+    def get_hash_index(self):
+
+        if not shared.opts.img2txt_hash_index_enabled:
+            return None
+
+        if self.hash_index is None:
+            self.hash_index = DeepDanbooruHashIndex(
+                os.path.join(shared.opts.outdir_extras_samples, "ddor", "hash_index.json")
+            )
+
+        self.hash_index.max_distance = int(shared.opts.img2txt_hash_max_distance)
+        return self.hash_index
 
     def on_ui_tabs(self):
 
@@ -688,7 +2712,7 @@ class DeepDanbooruObjectRecognitionScript():
                 with gr.Column(scale=1, elem_classes="source-image-col", width=512):
                     self.source_image = gr.Image(type="pil", label="Source Image", interactive=True, elem_id="source_image", height=256)
                     with gr.Column(scale=1, elem_classes="result-image-col"):
-                        self.result_image = gr.Image(type="pil", label="Recognized Image + Markers", interactive=False, elem_id="result_image", height=512)
+                        self.result_image = gr.AnnotatedImage(label="Recognized Image + Markers", elem_id="result_image", height=512)
 
                 # Img2Txt
                 with gr.Column(scale=1, elem_classes="other elements"):
@@ -734,16 +2758,42 @@ class DeepDanbooruObjectRecognitionScript():
                                     self.minimal_percentage = gr.Number(value=0.85, label="minimal_percentage",
                                                                         elem_id="minimal_percentage_ui", minimum=0,
                                                                         maximum=1)
+                                    self.merge_duplicates_chk = gr.Checkbox(value=True, label="Merge duplicated boxes",
+                                                                            elem_id="merge_duplicates_chk")
+                                    self.box_source_ui = gr.Radio(["windows", "density"], value="windows", label="Box source",
+                                                                  elem_id="box_source_ui")
                                 self.evaluate_m2_btn = gr.Button(value="[Step 2]Adavnced Markering (Method2)",
                                                                  elem_id="evaluete_m2_btn")
+                                self.export_markers_chk = gr.Checkbox(value=False, label="Export marker image",
+                                                                      elem_id="export_markers_chk")
+                                with gr.Row():
+                                    self.deadline_ui = gr.Number(value=0, label="Deadline seconds (0 = none)",
+                                                                 elem_id="deadline_ui", minimum=0)
+                                    self.max_evaluations_ui = gr.Number(value=0, label="Max window evaluations (0 = none)",
+                                                                        elem_id="max_evaluations_ui", minimum=0)
+                                    self.prescreen_ui = gr.Number(value=0.01, label="Prescreen threshold",
+                                                                  elem_id="prescreen_ui", minimum=0, maximum=1)
                                 self.sourceimage_info = gr.HTML("<p style='padding-bottom: 1em;' class=\"text-gray-500\">Png_info Parameters</p>")
                                 self.newimage_geninfo = gr.Textbox(value="", label="Parameters",elem_id="new_geninfo_parameters_txt")
                     with gr.Row(variant="compact", elem_id="png_info_parameters"):
                         self.sourceimage_geninfo = gr.Textbox(value="", label="PngInfo parameters", elem_id="png_geninfo_parameters_txt")
+                    with gr.Accordion("Animation / video", open=False, elem_id="img2txt_frames"):
+                        self.frames_file = gr.File(label="Animated image or video", elem_id="frames_file",
+                                                   file_types=[".gif", ".webp", ".png", ".mp4", ".webm", ".mov", ".avi", ".mkv"])
+                        self.frame_difference = gr.Number(value=0.04, label="Keyframe difference threshold",
+                                                          elem_id="frame_difference", minimum=0, maximum=1)
+                        self.interrogate_frames_btn = gr.Button(value="Interrogate frames", elem_id="interrogate_frames_btn")
+                        self.frame_segments = gr.Textbox(value="", label="Tags per segment", lines=4, elem_id="frame_segments_txt")
+                    with gr.Accordion("Performance", open=False, elem_id="img2txt_performance"):
+                        with gr.Row():
+                            self.benchmark_workers = gr.Number(value=max(1, (os.cpu_count() or 1) // 2), label="Benchmark up to workers",
+                                                               elem_id="benchmark_workers", minimum=1, maximum=os.cpu_count() or 1)
+                            self.benchmark_pool_btn = gr.Button(value="Benchmark CPU worker pool", elem_id="benchmark_pool_btn")
+                        self.calibrate_btn = gr.Button(value="Calibrate batch size and threads", elem_id="calibrate_btn")
                 # Main Generate
                 with gr.Column(scale=1, elem_classes="newgen-image-col"):
                     self.generate_image_btn = gr.Button(value="Generate", elem_id="generate_image_btn") #Preview btn
-                    self.generate_image = gr.Image(type="pil", label="Result Txt2Img", interactive=False, elem_id="generate_image", height=512)
+                    self.generate_image = gr.Gallery(label="Result Txt2Img", elem_id="generate_image", columns=3, height=512, object_fit="contain")
                     self.send_txt2img_btn = gr.Button(value="[WIP]Send to txt2img", elem_id="send_txt2img_btn")  # Send Best Example for Experiments
 
                     self.genimage_html = gr.HTML("<p style='padding-bottom: 1em;' class=\"text-gray-500\">Img2Txt Parameters</p>")
@@ -771,6 +2821,9 @@ class DeepDanbooruObjectRecognitionScript():
                                     self.batch_size = gr.Slider(minimum=1, maximum=9, step=1, label='Batch size',
                                                            value=1,
                                                            elem_id="txt2img_batch_size")
+                                    self.prompt_variants = gr.Slider(minimum=1, maximum=9, step=1, label='Tag subset variants',
+                                                                value=1,
+                                                                elem_id="img2txt_prompt_variants")
 
             with gr.Row():
                 self.log_label = gr.Label(value="", label="Log Processing", elem_id="log_label")
@@ -778,7 +2831,8 @@ class DeepDanbooruObjectRecognitionScript():
             #Create ExtraParameters
             self.Img2TxtSettings = (self.threshold_ui, self.max_display, self.steps, self.subdivisions, self.tolerance)
             self.GenerateSettings = (self.threshold_ui, self.max_display, self.steps, self.subdivisions, self.tolerance,
-                                     self.seed_ui, self.width, self.height, self.batch_count, self.batch_size)
+                                     self.seed_ui, self.width, self.height, self.batch_count, self.batch_size,
+                                     self.prompt_variants)
 
             #Quick Generate
             self.generate_image_btn.click(self.ui_generate_image_UseOnlyTag, inputs=[self.tags, self.source_image, *self.GenerateSettings], outputs=[self.generate_image, self.log_label, self.genimage_html, self.newimage_geninfo]) #, self.newimage_geninfo
@@ -792,9 +2846,20 @@ class DeepDanbooruObjectRecognitionScript():
                 outputs=[self.result_image, self.generate_image, self.log_label, self.tags, self.genimage_html, self.sourceimage_geninfo, self.sourceimage_info, self.newimage_geninfo],
             )
 
-            self.evaluate_btn.click(self.ui_click, inputs=[self.source_image, self.tags, self.threshold_ui, self.steps, self.subdivisions, self.tolerance], outputs=[self.result_image, self.log_label])
-            self.evaluate_m2_btn.click(self.ui_click_m2, inputs=[self.source_image, self.tags, self.kernel_x, self.kernel_y, self.step_x, self.step_y, self.minimal_percentage], outputs=[self.result_image, self.log_label])
+            budget_inputs = [self.deadline_ui, self.max_evaluations_ui, self.prescreen_ui]
+            self.evaluate_btn.click(self.ui_click, inputs=[self.source_image, self.tags, self.threshold_ui, self.steps, self.subdivisions, self.tolerance, self.export_markers_chk, *budget_inputs], outputs=[self.result_image, self.log_label])
+            heatmap_inputs = [self.source_image, self.tags, self.kernel_x, self.kernel_y, self.step_x, self.step_y, self.minimal_percentage, self.export_markers_chk, self.merge_duplicates_chk, *budget_inputs, self.box_source_ui]
+            self.evaluate_m2_btn.click(self.ui_click_m2, inputs=heatmap_inputs, outputs=[self.result_image, self.log_label])
             self.interrogate_btn.click(self.ui_interrogate, inputs=[self.source_image, self.threshold_ui, self.max_display], outputs=[self.tags, self.log_label])
+
+            # Post-processing changes are recomputed from the retained probabilities
+            for component in (self.threshold_ui, self.max_display):
+                component.change(self.ui_rethreshold, inputs=[self.source_image, self.threshold_ui, self.max_display], outputs=[self.tags, self.log_label])
+            for component in (self.minimal_percentage, self.merge_duplicates_chk, self.box_source_ui):
+                component.change(self.ui_reheatmap, inputs=heatmap_inputs, outputs=[self.result_image, self.log_label])
+            self.interrogate_frames_btn.click(self.ui_interrogate_frames, inputs=[self.frames_file, self.threshold_ui, self.max_display, self.frame_difference], outputs=[self.tags, self.frame_segments, self.log_label])
+            self.benchmark_pool_btn.click(self.ui_benchmark_pool, inputs=[self.benchmark_workers], outputs=[self.log_label])
+            self.calibrate_btn.click(self.ui_calibrate, inputs=[], outputs=[self.log_label])
             #Send PngInfo to SD
             self.send_txt2img_btn.click(self.send_parameters_txt2img, inputs=[self.newimage_geninfo])
 
@@ -805,40 +2870,31 @@ class DeepDanbooruObjectRecognitionScript():
 
 
     def ui_generate_image_UseOnlyTag(self, tags, source_image, request: gr.Request, *new_generate_settings):
-        _, geninfo, info = modules.extras.run_pnginfo(source_image)
         print("GenerateSettings : " + str(new_generate_settings))
         genset = new_generate_settings
 
         print("ui_generate_image tags: ["+tags+"]")
-        prompt = ""+tags
-        #regional_settings = (0,None, False, False, 'positive', 'comma', 0, False, False, '', 1, '', 0, '', 0, '', True, False, False, False, 0, None, False, 50)
-        List_images, newimage_geninfo, html_parameters, _ = modules.txt2img.txt2img(
-        'task(sj8csquzzbu7phv)', prompt, '', [], 20, 'DPM++ 2M Karras', 1, 1, 7, genset[7], genset[6], False, 0.7, 2, 'Latent', 0, 0, 0, 'Use same checkpoint', 'Use same sampler', '', '', [], request,
-        0, False, '', 0.8, -1, False, -1, 0, 0, 0, True, False, 1, False, False, False, 1.1, 1.5, 100, 0.7, False, False, True, False, False, 0, 'Gustavosta/MagicPrompt-Stable-Diffusion', '',
-        None, None, None,
-        None, False, 'cpu', 0.65, 0.7, None, True, None, '', None, True, False, False, False, False, False, 0, 0, '0', 0, False, True, 0, 'Portrait of a [gender]', 'blurry', 20, ['DPM++ 2M Karras'], '',
-        0, None, 1, 1, '', False, False, False, 1, 0, 'Portrait of a [gender]', 'blurry', 20, ['DPM++ 2M Karras'], '', 0, None, '', None, True, False, False, False, False, False, 0, 0, '0', 0, False, True,
-        0, 'Portrait of a [gender]', 'blurry', 20, ['DPM++ 2M Karras'], '', 0, None, 1, 1, '', False, False, False, 1, 0, 'Portrait of a [gender]', 'blurry', 20, ['DPM++ 2M Karras'], '',
-        0, None, '', None, True, False, False, False, False, False, 0, 0, '0', 0, False, True, 0, 'Portrait of a [gender]', 'blurry', 20, ['DPM++ 2M Karras'], '', 0, None, 1, 1, '',
-        False, False, False, 1, 0, 'Portrait of a [gender]', 'blurry', 20, ['DPM++ 2M Karras'], '', 0, None, 1, 1, '', 1, 1, ['After Upscaling/Before Restore Face'], 0, 'Portrait of a [gender]', 'blurry', 20, ['DPM++ 2M Karras'], '',
-        0, None, False, '0', '0', 'inswapper_128.onnx', 'CodeFormer', 1, True, 'None', 1, 1, False, True, 1, 0, 0, False, 0.5, True, False, 'CUDA', False, 0, 'None', '', None, False, False, False, False, 'positive', 'comma',
-        0, False, False, 'start', '', 1, '', [], 0, '', [], 0, '', [], True, False, False, False, 0, False, None, None, False, None, None, False, None, None, False, 50)
-        print("gen_info :"+str(newimage_geninfo))
-        if len(List_images) <= 1:
-            resultimage = List_images[0]
-        else:
-            return List_images[0], f"ManyImages!"
-        return resultimage, f"Complete request", html_parameters, newimage_geninfo
+        generator = Img2TxtGenerator(
+            width=genset[6],
+            height=genset[7],
+            seed=genset[5],
+            batch_count=genset[8],
+            batch_size=genset[9]
+        )
+        processed = generator.generate(tags, variants=genset[10], request=request)
+
+        print("gen_info :"+str(processed.info))
+        return processed.images, f"Complete request: {len(processed.images)} images", plaintext_to_html(processed.info), processed.js()
 
     def ui_generate_image_FromSource(self, source_image, full_preview, request: gr.Request, *generate_settings):
         print("=========================================================================IMG2TXT ui_generate_image_FromSource =========================================================================")
         print("GenerateSettings : " + str(generate_settings))
         # Init result image
         if not source_image:
-            return source_image, source_image, "No source image found", [], '', '', '', ''
+            return source_image, [], "No source image found", [], '', '', '', ''
 
         #Get all info from Image
-        _ , geninfo, info = modules.extras.run_pnginfo(source_image)
+        geninfo, info = DeepDanbooruMetadataReader.pnginfo(source_image)
         if geninfo:
             print("geninfo : " + geninfo)
             print("info : " + info)
@@ -846,15 +2902,18 @@ class DeepDanbooruObjectRecognitionScript():
             print("No png info! ImageSize " + str(source_image.size))
 
         new_generate_settings = (generate_settings[0], generate_settings[1], generate_settings[2], generate_settings[3], generate_settings[4],
-                                 generate_settings[5], source_image.size[0], source_image.size[1], generate_settings[8], generate_settings[9])
+                                 generate_settings[5], source_image.size[0], source_image.size[1], generate_settings[8], generate_settings[9],
+                                 generate_settings[10])
 
-        tags, _ = self.ui_interrogate_simple(source_image, generate_settings[0], generate_settings[1])
+        tags, interrogate_log = self.ui_interrogate_simple(source_image, generate_settings[0], generate_settings[1])
         if full_preview:
             marker_image, _ = self.ui_mark_simple(source_image, tags)
         else:
-            marker_image = source_image
+            preview = source_image.copy()
+            preview.thumbnail((512, 512))
+            marker_image = (preview, [])
         gen_image, log, img_parameters, new_gen_info = self.ui_generate_image_UseOnlyTag(tags, source_image, request, *new_generate_settings)
-        return marker_image, gen_image, f"Complete request", tags, img_parameters, geninfo, info, new_gen_info
+        return marker_image, gen_image, interrogate_log, tags, img_parameters, geninfo, info, new_gen_info
 
     def ui_interrogate(self, source_image_PIL, threshold_ui, max_display):
 
@@ -865,60 +2924,159 @@ class DeepDanbooruObjectRecognitionScript():
         dd_util = DeepDanbooruObjectRecognitionUtil(
             source_image_PIL,
             minimal_threshold=threshold_ui,
-            max_display=max_display
+            max_display=max_display,
+            hash_index=self.get_hash_index(),
+            dd_wrapper=self.get_wrapper(source_image_PIL)
         )
 
         dd_util.dd_wrapper.start()
         tag_probs = dd_util.extract_tags()
         dd_util.dd_wrapper.stop()
 
-        return ", ".join(tag_probs), f"Complete request"
+        return ", ".join(tag_probs), dd_util.status(f"Complete request")
 
 
-    def ui_click(self, source_image_PIL, tags, threshold_ui, steps, subdivisions, tolerance):
+    def ui_click(self, source_image_PIL, tags, threshold_ui, steps, subdivisions, tolerance, export_markers=False,
+                 deadline=0, max_evaluations=0, prescreen_threshold=0):
 
         # Init result image
         if not source_image_PIL:
             return None, "No source image found"
 
         dd_util = DeepDanbooruObjectRecognitionUtil(
-            source_image_PIL
+            source_image_PIL,
+            hash_index=self.get_hash_index(),
+            dd_wrapper=self.get_wrapper(source_image_PIL)
         )
 
         dd_util.dd_wrapper.start()
-        result_image_PIL = dd_util.create_rects(
+        markers = dd_util.create_rects(
             tags,
             int(steps),
             int(subdivisions),
-            tolerance
+            tolerance,
+            deadline or 0,
+            int(max_evaluations or 0),
+            prescreen_threshold or 0
         )
+        if export_markers:
+            dd_util.export_markers(markers)
         dd_util.dd_wrapper.stop()
 
-        return result_image_PIL, f"Complete request: extra-images/ddor/{dd_util.request_uuid}"
+        return dd_util.annotate_markers(markers), dd_util.status(f"Complete request: extra-images/ddor/{dd_util.request_uuid}")
 
-    def ui_click_m2(self, source_image_PIL, tags, kernel_x, kernel_y, step_x, step_y, minimal_percentage):
+    def ui_click_m2(self, source_image_PIL, tags, kernel_x, kernel_y, step_x, step_y, minimal_percentage, export_markers=False, merge_duplicates=True,
+                    deadline=0, max_evaluations=0, prescreen_threshold=0, box_source="windows"):
 
         # Init result image
         if not source_image_PIL:
             return None, "No source image found"
 
         dd_util = DeepDanbooruObjectRecognitionUtil(
-            source_image_PIL
+            source_image_PIL,
+            hash_index=self.get_hash_index(),
+            dd_wrapper=self.get_wrapper(source_image_PIL)
         )
 
         dd_util.dd_wrapper.start()
-        result_image_PIL = dd_util.create_heatmaps_util(
+        markers = dd_util.create_heatmaps_util(
             tags,
             int(kernel_x),
             int(kernel_y),
             int(step_x),
             int(step_y),
-            minimal_percentage
+            minimal_percentage,
+            merge_duplicates,
+            deadline or 0,
+            int(max_evaluations or 0),
+            prescreen_threshold or 0,
+            box_source or "windows"
         )
+        if export_markers:
+            dd_util.export_markers(markers)
         dd_util.dd_wrapper.stop()
+        self.retain_drawer(dd_util.dd_wrapper, dd_util.drawer)
+
+        return dd_util.annotate_markers(markers), dd_util.status(f"Complete request: extra-images/ddor/{dd_util.request_uuid}")
+
+
+    def ui_interrogate_frames(self, frames_file, threshold_ui, max_display, frame_difference):
+
+        if frames_file is None:
+            return gr.update(), "", "No animation or video found"
+
+        dd_wrapper = DeepDanbooruWrapper()
+        interrogator = DeepDanbooruFrameInterrogator(
+            dd_wrapper,
+            minimal_threshold=threshold_ui,
+            max_display=max_display,
+            difference_threshold=frame_difference
+        )
+
+        dd_wrapper.start()
+        tags, segments = interrogator.interrogate(getattr(frames_file, "name", frames_file))
+        dd_wrapper.stop()
+
+        segments_text = "\n".join(
+            f"frames {segment['start']}-{segment['end']}: {', '.join(segment['tags'])}" for segment in segments
+        )
+        return ", ".join(tags), segments_text, f"Complete request: {interrogator.frames} frames, {interrogator.keyframes} evaluated"
+
+    def ui_benchmark_pool(self, max_workers):
+
+        try:
+            results = DeepDanbooruProcessPool.benchmark(int(max_workers), int(shared.opts.img2txt_cpu_pool_threads))
+        except (ValueError, RuntimeError) as e:
+            return f"CPU worker pool benchmark failed: {e}"
+
+        return "Pool benchmark: " + ", ".join(f"{workers} workers {rate:.2f} windows/s" for workers, rate in results)
+
+    def ui_calibrate(self):
+
+        best = DeepDanbooruAutotuner.calibrate()
+        if best is None:
+            return "Calibration failed: no batch size fits in memory"
+
+        return f"Calibrated: batch size {best['batch_size']}, {best['threads']} threads, {best['windows_per_second']:.2f} windows/s"
+
+    def ui_rethreshold(self, source_image_PIL, threshold_ui, max_display):
+
+        # A field change never starts a new inference by itself
+        if not self.is_retained(source_image_PIL, "extract"):
+            return gr.update(), gr.update()
 
-        return result_image_PIL, f"Complete request: extra-images/ddor/{dd_util.request_uuid}"
+        return self.ui_interrogate(source_image_PIL, threshold_ui, max_display)
 
+    def ui_reheatmap(self, source_image_PIL, tags, kernel_x, kernel_y, step_x, step_y, minimal_percentage, export_markers=False, merge_duplicates=True,
+                     deadline=0, max_evaluations=0, prescreen_threshold=0, box_source="windows"):
+
+        # Only when this window geometry was already swept for the current image
+        dd_wrapper, drawer = self.retained(source_image_PIL)
+        if dd_wrapper is None or drawer is None or not dd_wrapper.is_cached(f"0-0-{int(kernel_y)}-{int(kernel_x)}"):
+            return gr.update(), gr.update()
+
+        # Boxes are recomputed in memory from the retained probabilities, artifacts
+        # are only written by the Method 2 button
+        dd_util = DeepDanbooruObjectRecognitionUtil(
+            source_image_PIL,
+            dd_wrapper=dd_wrapper,
+            artifacts=drawer.artifacts
+        )
+        dd_util.drawer = drawer
+        markers = dd_util.create_heatmaps_util(
+            tags,
+            int(kernel_x),
+            int(kernel_y),
+            int(step_x),
+            int(step_y),
+            minimal_percentage,
+            merge_duplicates,
+            prescreen_threshold=prescreen_threshold or 0,
+            box_source=box_source or "windows",
+            preview=True
+        )
+
+        return dd_util.annotate_markers(markers), dd_util.status("Recomputed from the retained probabilities")
 
     def ui_interrogate_simple(self, source_image_PIL, inputs0, inputs1):
 
@@ -930,14 +3088,16 @@ class DeepDanbooruObjectRecognitionScript():
         dd_util = DeepDanbooruObjectRecognitionUtil(
             source_image_PIL,
             inputs0,
-            inputs1
+            inputs1,
+            hash_index=self.get_hash_index(),
+            dd_wrapper=self.get_wrapper(source_image_PIL)
         )
 
         dd_util.dd_wrapper.start()
         tag_probs = dd_util.extract_tags()
         dd_util.dd_wrapper.stop()
 
-        return ", ".join(tag_probs), f"Complete request"
+        return ", ".join(tag_probs), dd_util.status(f"Complete request")
 
     def ui_mark_simple(self, source_image_PIL, tags):
 
@@ -946,11 +3106,13 @@ class DeepDanbooruObjectRecognitionScript():
             return None, "No source image found"
 
         dd_util = DeepDanbooruObjectRecognitionUtil(
-            source_image_PIL
+            source_image_PIL,
+            hash_index=self.get_hash_index(),
+            dd_wrapper=self.get_wrapper(source_image_PIL)
         )
 
         dd_util.dd_wrapper.start()
-        result_image_PIL = dd_util.create_rects(
+        markers = dd_util.create_rects(
             tags,
             10,
             3,
@@ -958,14 +3120,258 @@ class DeepDanbooruObjectRecognitionScript():
         )
         dd_util.dd_wrapper.stop()
 
-        return result_image_PIL, f"Complete request: extra-images/ddor/{dd_util.request_uuid}"
+        return dd_util.annotate_markers(markers), dd_util.status(f"Complete request: extra-images/ddor/{dd_util.request_uuid}")
 
     def send_to_PngInfo(self):
 
         pnginfo_interface
 
+class Img2TxtInterrogateRequest(BaseModel):
+    images: list = Field(title="Images", description="Base64 encoded images")
+    threshold: float = Field(default=0.5, title="Threshold")
+    max_display: int = Field(default=10, title="Max tags per image")
+
+class Img2TxtPngInfoRequest(BaseModel):
+    images: list = Field(title="Images", description="Base64 encoded image files")
+
+class Img2TxtRectRequest(BaseModel):
+    images: list = Field(title="Images", description="Base64 encoded images")
+    tags: str = Field(title="Tags", description="Comma separated tags to locate")
+    steps: int = Field(default=10, title="Steps", ge=1)
+    subdivisions: int = Field(default=3, title="Subdivisions", ge=1)
+    tolerance: float = Field(default=0.05, title="Tolerance")
+    deadline: float = Field(default=0, title="Deadline", description="Seconds, 0 for none", ge=0)
+    max_evaluations: int = Field(default=0, title="Max window evaluations", description="0 for none", ge=0)
+    prescreen_threshold: float = Field(default=0, title="Prescreen threshold")
+
+class Img2TxtHeatmapRequest(BaseModel):
+    images: list = Field(title="Images", description="Base64 encoded images")
+    tags: str = Field(title="Tags", description="Comma separated tags to locate")
+    # A kernel of 512 leaves no room to slide inside the 512x512 input, the grids come back empty
+    kernel_x: int = Field(default=64, title="Kernel X", ge=8, le=511)
+    kernel_y: int = Field(default=64, title="Kernel Y", ge=8, le=511)
+    step_x: int = Field(default=32, title="Step X", ge=1)
+    step_y: int = Field(default=32, title="Step Y", ge=1)
+    minimal_percentage: float = Field(default=0.85, title="Minimal percentage")
+    merge_duplicates: bool = Field(default=True, title="Merge duplicated boxes")
+    deadline: float = Field(default=0, title="Deadline", description="Seconds, 0 for none", ge=0)
+    max_evaluations: int = Field(default=0, title="Max window evaluations", description="0 for none", ge=0)
+    prescreen_threshold: float = Field(default=0, title="Prescreen threshold")
+    box_source: str = Field(default="windows", title="Box source", description="windows or density")
+
+class Img2TxtApi:
+
+    def __init__(
+        self,
+        wrapper_factory = DeepDanbooruWrapper
+    ):
+
+        self.wrapper_factory = wrapper_factory
+        self.dd_wrapper = None
+        self.lock = threading.Lock()
+
+    def register(self, app):
+
+        app.add_api_route("/img2txt/interrogate", self.interrogate, methods=["POST"])
+        app.add_api_route("/img2txt/rect", self.rect, methods=["POST"])
+        app.add_api_route("/img2txt/heatmap", self.heatmap, methods=["POST"])
+        app.add_api_route("/img2txt/pnginfo", self.pnginfo, methods=["POST"])
+
+    def get_wrapper(self):
+
+        # The model stays resident between calls
+        if self.dd_wrapper is None:
+            self.dd_wrapper = self.wrapper_factory()
+            self.dd_wrapper.start()
+
+        return self.dd_wrapper
+
+    @staticmethod
+    def decode_images(encoded_images):
+
+        from modules.api.api import decode_base64_to_image
+        return [decode_base64_to_image(encoded) for encoded in encoded_images]
+
+    @staticmethod
+    def decode_files(encoded_images):
+
+        # Raw file bytes, the metadata is read without decoding the pixels
+        return [base64.b64decode(encoded.split(";base64,", 1)[-1]) for encoded in encoded_images]
+
+    @staticmethod
+    def marker_boxes(markers):
+
+        return [
+            {
+                "tag": marker["tag"],
+                "top": int(marker["top"]),
+                "left": int(marker["left"]),
+                "bottom": int(marker["bottom"]),
+                "right": int(marker["right"]),
+                "prob": float(marker["prob"])
+            }
+            for marker in markers
+        ]
+
+    def interrogate(self, req: Img2TxtInterrogateRequest):
+
+        pil_images = self.decode_images(req.images)
+
+        with self.lock:
+            dd_wrapper = self.get_wrapper()
+            # All images of the call go through the classifier together
+            outputs = dd_wrapper.evaluate_batch(pil_images, ["" for _ in pil_images])
+
+            results = []
+            for y in outputs:
+                probabilities = dd_wrapper.probabilities_to_tags(y, req.threshold)
+                probabilities = dict(sorted(probabilities.items(), key=lambda x: -x[1])[0:req.max_display])
+                results.append({
+                    "tags": list(probabilities.keys()),
+                    "probabilities": {tag: float(prob) for tag, prob in probabilities.items()}
+                })
+
+        return {"results": results}
+
+    def pnginfo(self, req: Img2TxtPngInfoRequest):
+
+        results = []
+        for data in self.decode_files(req.images):
+            geninfo, info = DeepDanbooruMetadataReader.pnginfo(data)
+            results.append({"geninfo": geninfo or "", "info": info})
+
+        return {"results": results}
+
+    @staticmethod
+    def prefetch_windows(dd_wrapper, pil_images, windows):
+
+        # Windows of every image of the call share the classifier batches,
+        # the vectors are then split back into one cache per image
+        caches = [OrderedDict() for _ in pil_images]
+        drawers = [None] * len(pil_images)
+        pending = [(i, window) for i in range(len(pil_images)) for window in windows]
+
+        capacity = dd_wrapper.batch_capacity()
+        for start in range(0, len(pending), capacity):
+            chunk = pending[start:start + capacity]
+
+            crops = []
+            for i, window in chunk:
+                if drawers[i] is None:
+                    drawers[i] = DeepDanbooruObjectDrawer(pil_images[i], "", None)
+                crops.append(drawers[i].crop(*window))
+
+            outputs = dd_wrapper.evaluate_batch(crops, ["" for _ in chunk])
+            for (i, window), y in zip(chunk, outputs):
+                caches[i]['{}-{}-{}-{}'.format(*window)] = y
+
+        return caches
+
+    def locate(self, pil_images, run, windows=None):
+
+        results = []
+        with self.lock:
+            dd_wrapper = self.get_wrapper()
+            caches = self.prefetch_windows(dd_wrapper, pil_images, windows) if windows else None
+
+            for i, pil_image in enumerate(pil_images):
+                # Window ids are only unique within one image
+                dd_wrapper.cache = caches[i] if caches else OrderedDict()
+                dd_util = DeepDanbooruObjectRecognitionUtil(pil_image, dd_wrapper=dd_wrapper)
+                results.append({
+                    "request_uuid": dd_util.request_uuid,
+                    "boxes": self.marker_boxes(run(dd_util))
+                })
+
+            dd_wrapper.cache = OrderedDict()
+
+        return {"results": results}
+
+    def rect(self, req: Img2TxtRectRequest):
+
+        return self.locate(
+            self.decode_images(req.images),
+            lambda dd_util: dd_util.create_rects(
+                req.tags,
+                req.steps,
+                req.subdivisions,
+                req.tolerance,
+                req.deadline,
+                req.max_evaluations,
+                req.prescreen_threshold
+            )
+        )
+
+    def heatmap(self, req: Img2TxtHeatmapRequest):
+
+        # Without a budget or prescreening every window of every image is needed, so they
+        # are evaluated together. Budgeted sweeps and rect searches run image by image
+        windows = None
+        if not (req.deadline or req.max_evaluations or req.prescreen_threshold):
+            windows = [
+                (top, left, top + req.kernel_y, left + req.kernel_x)
+                for top in range(0, 512 - req.kernel_y, req.step_y)
+                for left in range(0, 512 - req.kernel_x, req.step_x)
+            ]
+
+        return self.locate(
+            self.decode_images(req.images),
+            lambda dd_util: dd_util.create_heatmaps_util(
+                req.tags,
+                req.kernel_x,
+                req.kernel_y,
+                req.step_x,
+                req.step_y,
+                req.minimal_percentage,
+                req.merge_duplicates,
+                req.deadline,
+                req.max_evaluations,
+                req.prescreen_threshold,
+                req.box_source
+            ),
+            windows
+        )
+
+def on_ui_settings():
+
+    section = ("img2txt", "Img2Txt")
+    shared.opts.add_option(
+        "img2txt_hash_index_enabled",
+        shared.OptionInfo(False, "Reuse tags and markers of near-duplicate images (perceptual hash index)", section=section)
+    )
+    shared.opts.add_option(
+        "img2txt_hash_max_distance",
+        shared.OptionInfo(4, "Maximum perceptual hash distance to treat an image as a near-duplicate", gr.Slider, {"minimum": 0, "maximum": 32, "step": 1}, section=section)
+    )
+    shared.opts.add_option(
+        "img2txt_cpu_pool_workers",
+        shared.OptionInfo(0, "DeepDanbooru CPU worker processes (0 = run in the webui process, Linux only)", gr.Slider, {"minimum": 0, "maximum": max(1, os.cpu_count() or 1), "step": 1}, section=section)
+    )
+    shared.opts.add_option(
+        "img2txt_cpu_pool_threads",
+        shared.OptionInfo(1, "Torch threads per DeepDanbooru CPU worker", gr.Slider, {"minimum": 1, "maximum": max(1, os.cpu_count() or 1), "step": 1}, section=section)
+    )
+    shared.opts.add_option(
+        "img2txt_retention_max_mb",
+        shared.OptionInfo(0, "Maximum total size of exported request folders in MB (0 = unlimited)", gr.Number, section=section)
+    )
+    shared.opts.add_option(
+        "img2txt_retention_max_days",
+        shared.OptionInfo(0, "Maximum age of exported request folders in days (0 = unlimited)", gr.Number, section=section)
+    )
+    shared.opts.add_option(
+        "img2txt_retention_max_requests",
+        shared.OptionInfo(0, "Maximum number of exported request folders (0 = unlimited)", gr.Number, section=section)
+    )
+
+def on_app_started(demo, app):
+    img2txt_api.register(app)
+
 ddors = DeepDanbooruObjectRecognitionScript()
+img2txt_api = Img2TxtApi()
+script_callbacks.on_ui_settings(on_ui_settings)
 script_callbacks.on_ui_tabs(ddors.on_ui_tabs)
+script_callbacks.on_app_started(on_app_started)
 
 # end of file
 """
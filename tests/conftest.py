@@ -0,0 +1,39 @@
+import importlib.util
+import os
+
+import pytest
+
+# The script imports webui modules, so the tests run from a webui checkout
+# with this extension under extensions/
+pytest.importorskip("modules.scripts")
+
+
+def pytest_addoption(parser):
+
+    parser.addoption("--record-golden", action="store_true",
+                     help="overwrite golden/img2txt_golden.json with the reference path outputs")
+
+
+@pytest.fixture(scope="session")
+def img2txt():
+
+    from modules import shared, shared_init
+
+    if shared.opts is None:
+        shared_init.initialize()
+
+    path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts", "img2txt.py"))
+    spec = importlib.util.spec_from_file_location("img2txt", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    module.on_ui_settings()
+    return module
+
+
+@pytest.fixture
+def outdir(img2txt, tmp_path, monkeypatch):
+
+    monkeypatch.setattr(img2txt.shared.opts, "outdir_extras_samples", str(tmp_path))
+    monkeypatch.setattr(img2txt.shared.opts, "img2txt_cpu_pool_workers", 0)
+    return tmp_path
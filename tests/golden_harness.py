@@ -0,0 +1,253 @@
+"""Fake classifier and golden-output harness for the recognition fast paths.
+
+Kept out of scripts/img2txt.py so webui does not load them on every start.
+"""
+import json
+import os
+import tempfile
+import uuid
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+class DeepDanbooruFakeClassifier:
+
+    class Model:
+
+        tags = ["red", "green", "blue", "white", "rating:safe"]
+
+        def __call__(self, x):
+
+            # Each tag scores the share of its color among the non black pixels,
+            # black being the padding added around crops
+            r, g, b = x[..., 0], x[..., 1], x[..., 2]
+            masks = [
+                (r > 0.6) & (g < 0.4) & (b < 0.4),
+                (g > 0.6) & (r < 0.4) & (b < 0.4),
+                (b > 0.6) & (r < 0.4) & (g < 0.4),
+                (r > 0.8) & (g > 0.8) & (b > 0.8),
+            ]
+            visible = ((r > 0.1) | (g > 0.1) | (b > 0.1)).float().sum(dim=(1, 2)) + 1
+            probs = torch.stack([mask.float().sum(dim=(1, 2)) / visible for mask in masks], dim=1)
+            return torch.cat([probs, torch.full_like(probs[:, :1], 0.5)], dim=1)
+
+    def __init__(self):
+        self.model = self.Model()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class DeepDanbooruGoldenHarness:
+
+    default_tolerances = {"prob": 1e-4, "box": 0, "grid": 1e-3}
+
+    reference = {"batch_size": 1, "use_pool": False, "rect": {}, "heatmap": {}, "preview": False}
+
+    # The CPU worker pool loads the real model, so it cannot be checked against the fake classifier.
+    # A budget large enough for every window still goes through the scheduled sweep, and the
+    # preview recomputes the boxes from the retained probabilities only
+    fast_paths = {
+        "reference": {},
+        "batched": {"batch_size": 8},
+        "prescreen": {"rect": {"prescreen_threshold": 0.01}, "heatmap": {"prescreen_threshold": 0.01}},
+        "budgeted": {"batch_size": 8, "rect": {"max_evaluations": 100000}, "heatmap": {"max_evaluations": 100000}},
+        "preview": {"batch_size": 8, "preview": True},
+    }
+
+    def __init__(
+        self,
+        img2txt,
+        golden_path = None,
+        corpus = None
+    ):
+
+        # img2txt is the extension script loaded by the test fixture
+        self.img2txt = img2txt
+        self.golden_path = golden_path or os.path.join(base_dir, "golden", "img2txt_golden.json")
+        self.corpus = corpus if corpus is not None else self.default_corpus()
+
+    @staticmethod
+    def default_corpus():
+
+        corpus = []
+
+        im = Image.new("RGB", (512, 384), (128, 128, 128))
+        ImageDraw.Draw(im).rectangle([64, 64, 192, 192], fill=(230, 20, 20))
+        corpus.append(("red_square", im))
+
+        im = Image.new("RGB", (640, 480), (250, 250, 250))
+        draw = ImageDraw.Draw(im)
+        draw.rectangle([380, 40, 600, 200], fill=(20, 220, 20))
+        draw.ellipse([60, 240, 300, 460], fill=(20, 20, 230))
+        corpus.append(("green_blue", im))
+
+        gradient = np.zeros((300, 300, 3), dtype=np.uint8)
+        gradient[..., 0] = np.linspace(255, 0, 300, dtype=np.uint8)[None, :]
+        gradient[..., 2] = np.linspace(0, 255, 300, dtype=np.uint8)[None, :]
+        corpus.append(("gradient", Image.fromarray(gradient)))
+
+        noise = np.random.default_rng(0).integers(0, 256, (256, 256, 3), dtype=np.uint8)
+        corpus.append(("noise", Image.fromarray(noise)))
+
+        # Committed with the extension, a missing sample fails the run instead of shrinking the corpus
+        with Image.open(os.path.join(base_dir, "sd-webui-img2txt.jpg")) as im:
+            corpus.append(("sample", im.convert("RGB")))
+
+        return corpus
+
+    @staticmethod
+    def marker_boxes(markers):
+
+        boxes = {}
+        for marker in markers:
+            boxes.setdefault(marker["tag"], []).append(
+                [int(marker["top"]), int(marker["left"]), int(marker["bottom"]), int(marker["right"]), float(marker["prob"])]
+            )
+        return boxes
+
+    def run(self, fast_path=None):
+
+        config = dict(self.reference, **(fast_path or {}))
+        tags = ", ".join(tag for tag in DeepDanbooruFakeClassifier.Model.tags if not tag.startswith("rating:"))
+        results = {}
+
+        for name, pil_image in self.corpus:
+
+            dd_wrapper = self.img2txt.DeepDanbooruWrapper(classifier=DeepDanbooruFakeClassifier())
+            dd_wrapper.use_pool = config["use_pool"]
+            dd_wrapper.use_profile = False
+            dd_wrapper.batch_size = config["batch_size"]
+
+            with tempfile.TemporaryDirectory() as tmp_directory:
+
+                request_uuid = str(uuid.uuid1())
+                dd_util = self.img2txt.DeepDanbooruObjectRecognitionUtil(
+                    pil_image,
+                    minimal_threshold=0,
+                    max_display=100,
+                    dd_wrapper=dd_wrapper,
+                    artifacts=self.img2txt.DeepDanbooruArtifactStore(tmp_directory, request_uuid)
+                )
+
+                dd_wrapper.start()
+                dd_util.extract_tags()
+                probabilities = dd_wrapper.probabilities_to_tags(dd_wrapper.cache["extract"])
+                rects = dd_util.create_rects(tags, 10, 3, 0.05, **config["rect"])
+                heatmaps = dd_util.create_heatmaps_util(tags, 64, 64, 32, 32, 0.5, **config["heatmap"])
+                if config["preview"]:
+                    heatmaps = dd_util.create_heatmaps_util(tags, 64, 64, 32, 32, 0.5, **config["heatmap"], preview=True)
+                density = dd_util.create_heatmaps_util(
+                    tags, 64, 64, 32, 32, 0.5, **config["heatmap"], box_source="density", preview=config["preview"]
+                )
+
+                grid = None
+                grid_store = self.img2txt.DeepDanbooruGridStore
+                if os.path.exists(os.path.join(dd_util.export_directory, grid_store.meta_name)):
+                    meta, grid_array = grid_store.load(dd_util.export_directory)
+                    grid = {"tags": meta["tags"], "values": np.asarray(grid_array, dtype=np.float32).tolist()}
+                    del grid_array
+                dd_wrapper.stop()
+
+            results[name] = {
+                "skipped": [tag for tag, _ in dd_util.skipped],
+                "tags": {tag: float(prob) for tag, prob in probabilities.items()},
+                "rects": self.marker_boxes(rects),
+                "heatmaps": self.marker_boxes(heatmaps),
+                "density": self.marker_boxes(density),
+                "grid": grid
+            }
+
+        return results
+
+    def record(self):
+
+        # Only from a checkout, the reviewed golden file is the truth the fast paths are held to
+        results = self.run()
+        os.makedirs(os.path.dirname(self.golden_path), exist_ok=True)
+        with open(self.golden_path, "w") as _f:
+            _f.write(json.dumps(results, indent=1))
+
+        return results
+
+    @staticmethod
+    def diff_boxes(name, kind, golden, current, tolerances, skipped=()):
+
+        diffs = []
+        for tag in sorted(set(golden) | set(current)):
+            if tag in skipped and tag not in current:
+                continue
+
+            golden_boxes = golden.get(tag, [])
+            current_boxes = current.get(tag, [])
+
+            if len(golden_boxes) != len(current_boxes):
+                diffs.append(f"{name} {kind} {tag}: {len(golden_boxes)} boxes expected, {len(current_boxes)} found")
+                continue
+
+            for golden_box, current_box in zip(golden_boxes, current_boxes):
+                if max(abs(a - b) for a, b in zip(golden_box[:4], current_box[:4])) > tolerances["box"] or \
+                   abs(golden_box[4] - current_box[4]) > tolerances["prob"]:
+                    diffs.append(f"{name} {kind} {tag}: {golden_box} expected, {current_box} found")
+
+        return diffs
+
+    def compare(self, fast_path, tolerances=None):
+
+        tolerances = dict(self.default_tolerances, **(tolerances or {}))
+        with open(self.golden_path, "r") as _f:
+            golden = json.loads(_f.read())
+
+        current = self.run(fast_path)
+        diffs = []
+
+        for name in sorted(set(golden) | set(current)):
+            if name not in golden or name not in current:
+                diffs.append(f"{name}: only in {'current' if name in current else 'golden'} outputs")
+                continue
+
+            expected, found = golden[name], current[name]
+
+            if set(expected["tags"]) != set(found["tags"]):
+                diffs.append(f"{name} tags: {sorted(expected['tags'])} expected, {sorted(found['tags'])} found")
+            for tag in set(expected["tags"]) & set(found["tags"]):
+                if abs(expected["tags"][tag] - found["tags"][tag]) > tolerances["prob"]:
+                    diffs.append(f"{name} tag {tag}: {expected['tags'][tag]} expected, {found['tags'][tag]} found")
+
+            # Tags a fast path deliberately skipped are not differences
+            skipped = set(found["skipped"])
+            diffs += self.diff_boxes(name, "rect", expected["rects"], found["rects"], tolerances, skipped)
+            diffs += self.diff_boxes(name, "heatmap", expected["heatmaps"], found["heatmaps"], tolerances, skipped)
+            diffs += self.diff_boxes(name, "density", expected["density"], found["density"], tolerances, skipped)
+
+            if found["grid"] is None and expected["grid"] is not None and set(expected["grid"]["tags"]) <= skipped:
+                # Every tag was skipped, nothing was localized
+                pass
+            elif (expected["grid"] is None) != (found["grid"] is None):
+                diffs.append(f"{name} grid: missing in {'current' if found['grid'] is None else 'golden'} outputs")
+            elif expected["grid"] is not None:
+                # Only the tags both runs localized are compared, prescreening may skip some
+                for tag in set(expected["grid"]["tags"]) & set(found["grid"]["tags"]):
+                    a = np.array(expected["grid"]["values"][expected["grid"]["tags"].index(tag)], dtype=np.float32)
+                    b = np.array(found["grid"]["values"][found["grid"]["tags"].index(tag)], dtype=np.float32)
+                    if a.shape != b.shape:
+                        diffs.append(f"{name} grid {tag}: shape {a.shape} expected, {b.shape} found")
+                    elif np.nanmax(np.abs(a - b), initial=0) > tolerances["grid"] or not np.array_equal(np.isnan(a), np.isnan(b)):
+                        diffs.append(f"{name} grid {tag}: max difference {np.nanmax(np.abs(a - b), initial=0):.5f}")
+
+        return diffs
+
+    def check_fast_paths(self, tolerances=None):
+
+        # Recording here would accept whatever the current code does as the truth
+        if not os.path.exists(self.golden_path):
+            raise FileNotFoundError(f"Golden outputs not found at {self.golden_path}, they are recorded from the reference path and committed")
+
+        return {name: self.compare(fast_path, tolerances) for name, fast_path in self.fast_paths.items()}
@@ -0,0 +1,150 @@
+import base64
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw
+
+fastapi = pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+
+from golden_harness import DeepDanbooruFakeClassifier
+
+
+def encode(pil_image):
+
+    buffer = BytesIO()
+    pil_image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def red_square(box):
+
+    im = Image.new("RGB", (512, 512), (128, 128, 128))
+    ImageDraw.Draw(im).rectangle(box, fill=(230, 20, 20))
+    return im
+
+
+@pytest.fixture
+def evaluated():
+
+    # Windows per classifier call
+    return []
+
+
+@pytest.fixture
+def client(img2txt, outdir, evaluated):
+
+    def fake_wrapper():
+        wrapper = img2txt.DeepDanbooruWrapper(classifier=DeepDanbooruFakeClassifier())
+        wrapper.use_pool = False
+        wrapper.use_profile = False
+
+        run_model = wrapper.run_model
+        def counted_run_model(arrays):
+            evaluated.append(len(arrays))
+            return run_model(arrays)
+        wrapper.run_model = counted_run_model
+
+        return wrapper
+
+    app = fastapi.FastAPI()
+    img2txt.Img2TxtApi(wrapper_factory=fake_wrapper).register(app)
+    return TestClient(app)
+
+
+def test_interrogate(client):
+
+    response = client.post("/img2txt/interrogate", json={
+        "images": [encode(red_square([0, 0, 511, 511])), encode(Image.new("RGB", (256, 256), (20, 220, 20)))],
+        "threshold": 0.5
+    })
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["tags"] for result in results] == [["red"], ["green"]]
+    assert "rating:safe" not in results[0]["probabilities"]
+
+
+def test_rect(client):
+
+    response = client.post("/img2txt/rect", json={
+        "images": [encode(red_square([64, 64, 192, 192]))],
+        "tags": "red, blue"
+    })
+
+    assert response.status_code == 200
+    boxes = response.json()["results"][0]["boxes"]
+    red = [box for box in boxes if box["tag"] == "red"]
+    blue = [box for box in boxes if box["tag"] == "blue"]
+    assert len(red) == 1
+    assert red[0]["prob"] > max([box["prob"] for box in blue], default=0)
+    assert red[0]["top"] < 192 and red[0]["bottom"] > 64
+
+
+@pytest.mark.parametrize("box_source", ["windows", "density"])
+def test_heatmap(client, box_source):
+
+    # Two images so the windows of both share classifier batches
+    response = client.post("/img2txt/heatmap", json={
+        "images": [encode(red_square([64, 64, 192, 192])), encode(red_square([320, 320, 448, 448]))],
+        "tags": "red",
+        "minimal_percentage": 0.5,
+        "box_source": box_source
+    })
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 2
+
+    for result, (low, high) in zip(results, [(64, 192), (320, 448)]):
+        assert result["boxes"]
+        for box in result["boxes"]:
+            assert box["tag"] == "red"
+            center_y = (box["top"] + box["bottom"]) / 2
+            center_x = (box["left"] + box["right"]) / 2
+            assert low <= center_y <= high and low <= center_x <= high
+
+
+def test_heatmap_budget(client, evaluated):
+
+    # 64x64 kernels every 32 pixels are 196 windows, the budget covers a fifth of them
+    response = client.post("/img2txt/heatmap", json={
+        "images": [encode(red_square([64, 64, 192, 192]))],
+        "tags": "red",
+        "minimal_percentage": 0.5,
+        "max_evaluations": 40
+    })
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 1
+
+    # The whole image ranks the tags once, then the sweep stops at the budget
+    assert sum(evaluated) <= 40 + 1
+    assert sum(evaluated) < 196
+
+    # The sweep starts where the tag scores highest, so the best boxes so far cover the square
+    boxes = results[0]["boxes"]
+    assert boxes
+    for box in boxes:
+        assert box["tag"] == "red"
+        assert 64 <= (box["top"] + box["bottom"]) / 2 <= 192
+        assert 64 <= (box["left"] + box["right"]) / 2 <= 192
+
+
+@pytest.mark.parametrize("endpoint, fields", [
+    ("/img2txt/heatmap", {"step_x": 0}),
+    ("/img2txt/heatmap", {"step_y": 0}),
+    ("/img2txt/heatmap", {"kernel_x": 512}),
+    ("/img2txt/heatmap", {"kernel_y": 4}),
+    ("/img2txt/rect", {"subdivisions": 0}),
+    ("/img2txt/rect", {"steps": 0}),
+])
+def test_out_of_range_fields(client, endpoint, fields):
+
+    response = client.post(endpoint, json=dict({
+        "images": [encode(red_square([64, 64, 192, 192]))],
+        "tags": "red"
+    }, **fields))
+
+    assert response.status_code == 422
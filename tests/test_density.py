@@ -0,0 +1,28 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+from golden_harness import DeepDanbooruFakeClassifier
+
+
+def test_full_resolution_density_from_grid_store(img2txt, outdir):
+
+    im = Image.new("RGB", (640, 480), (128, 128, 128))
+    ImageDraw.Draw(im).rectangle([64, 64, 224, 224], fill=(230, 20, 20))
+
+    dd_wrapper = img2txt.DeepDanbooruWrapper(classifier=DeepDanbooruFakeClassifier())
+    dd_wrapper.use_pool = False
+    dd_wrapper.use_profile = False
+    dd_util = img2txt.DeepDanbooruObjectRecognitionUtil(im, dd_wrapper=dd_wrapper)
+    dd_util.create_heatmaps_util("red", 64, 64, 32, 32, 0.5)
+
+    density = img2txt.DeepDanbooruGridStore.density_image(dd_util.export_directory, "red", im)
+
+    assert density.size == im.size
+    pixels = np.asarray(density, dtype=np.float32) / 255
+    assert pixels[144, 144] > 0.5
+    assert pixels[400, 500] < 0.1
+
+    # The stored preview is the same map at 512
+    with Image.open(f"{dd_util.export_directory}/density_red.png") as preview:
+        resized = np.asarray(preview.resize(im.size, Image.BILINEAR), dtype=np.float32) / 255
+    assert np.abs(resized - pixels).max() < 0.02
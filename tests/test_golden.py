@@ -0,0 +1,12 @@
+from golden_harness import DeepDanbooruGoldenHarness
+
+
+def test_fast_paths_match_golden(img2txt, outdir, request):
+
+    harness = DeepDanbooruGoldenHarness(img2txt)
+    if request.config.getoption("--record-golden"):
+        harness.record()
+
+    # The golden file is recorded from the reference path and committed, a missing file fails here
+    report = harness.check_fast_paths()
+    assert report == {name: [] for name in DeepDanbooruGoldenHarness.fast_paths}
@@ -0,0 +1,116 @@
+import struct
+import zlib
+
+import pytest
+from PIL import Image, PngImagePlugin
+
+piexif = pytest.importorskip("piexif")
+import piexif.helper
+
+
+PARAMETERS = "a red square\nNegative prompt: blurry\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x512"
+
+
+def user_comment_exif():
+
+    return piexif.dump({"Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(PARAMETERS, encoding="unicode")}})
+
+
+def png_text(path):
+
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text("parameters", PARAMETERS)
+    pnginfo.add_itxt("Title", "ünïcode", lang="en", tkey="Titel")
+    pnginfo.add_text("Description", "x" * 2048, zip=True)
+    Image.new("RGB", (96, 64), (200, 30, 30)).save(path, pnginfo=pnginfo, dpi=(72, 72))
+
+
+def png_trailing_text(path):
+
+    png_text(path)
+    data = path.read_bytes()
+    body = b"tEXt" + b"Software\0webui"
+    chunk = struct.pack(">I", len(body) - 4) + body + struct.pack(">I", zlib.crc32(body))
+    iend = data.rindex(b"IEND") - 4
+    path.write_bytes(data[:iend] + chunk + data[iend:])
+
+
+def png_palette(path):
+
+    im = Image.new("P", (32, 32), 1)
+    im.putpalette([0, 0, 0, 255, 0, 0] + [0] * 762)
+    im.save(path, transparency=0)
+
+
+def png_palette_alpha(path):
+
+    im = Image.new("P", (32, 32), 1)
+    im.putpalette([0, 0, 0, 255, 0, 0, 0, 255, 0] + [0] * 759)
+    im.save(path, transparency=bytes([0, 128, 255]))
+
+
+def png_rgb_transparency(path):
+
+    Image.new("RGB", (16, 16), (10, 20, 30)).save(path, transparency=(10, 20, 30))
+
+
+def apng(path):
+
+    frames = [Image.new("RGB", (48, 48), color) for color in ((255, 0, 0), (0, 255, 0), (0, 0, 255))]
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text("parameters", PARAMETERS)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=2, disposal=1, blend=0, pnginfo=pnginfo)
+
+
+def jpeg(path):
+
+    Image.new("RGB", (80, 60), (30, 30, 200)).save(path, exif=user_comment_exif(), comment=b"jpeg comment")
+
+
+def jpeg_plain(path):
+
+    Image.new("RGB", (80, 60), (30, 30, 200)).save(path, quality=90, progressive=True)
+
+
+def webp(path):
+
+    Image.new("RGB", (70, 50), (30, 200, 30)).save(path, exif=user_comment_exif())
+
+
+@pytest.mark.parametrize("name, write", [
+    ("text.png", png_text),
+    ("trailing.png", png_trailing_text),
+    ("palette.png", png_palette),
+    ("palette_alpha.png", png_palette_alpha),
+    ("rgb_transparency.png", png_rgb_transparency),
+    ("animated.png", apng),
+    ("exif.jpg", jpeg),
+    ("plain.jpg", jpeg_plain),
+    ("exif.webp", webp),
+])
+def test_pnginfo_matches_decoded_image(img2txt, tmp_path, name, write):
+
+    path = tmp_path / name
+    write(path)
+
+    # webui passes images already decoded, which also reads chunks after the pixel data
+    with Image.open(path) as im:
+        im.load()
+        _, geninfo, info = img2txt.run_pnginfo(im)
+
+    assert img2txt.DeepDanbooruMetadataReader.pnginfo(str(path)) == (geninfo, info)
+    assert img2txt.DeepDanbooruMetadataReader.pnginfo(path.read_bytes()) == (geninfo, info)
+
+
+def test_iter_directory(img2txt, tmp_path):
+
+    png_text(tmp_path / "a.png")
+    jpeg(tmp_path / "b.jpg")
+    (tmp_path / "notes.txt").write_text("not an image")
+    (tmp_path / "broken.png").write_bytes(b"\x89PNG\r\n\x1a\n\x00\x00")
+
+    results = {path.rsplit("/", 1)[-1]: geninfo for path, geninfo, _ in img2txt.DeepDanbooruMetadataReader.iter_directory(str(tmp_path))}
+
+    assert results["a.png"] == PARAMETERS
+    assert results["b.jpg"] == PARAMETERS
+    assert "notes.txt" not in results
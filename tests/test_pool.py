@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from golden_harness import DeepDanbooruFakeClassifier
+
+
+class FakePool:
+
+    def __init__(self, tags):
+
+        self.tags = tags
+        self.capacity = 16
+        self.calls = 0
+
+    def evaluate(self, arrays):
+
+        self.calls += 1
+        return list(np.full((len(arrays), len(self.tags)), 0.5, dtype=np.float32))
+
+
+def test_closed_pool_raises(img2txt):
+
+    pool = img2txt.DeepDanbooruProcessPool.__new__(img2txt.DeepDanbooruProcessPool)
+    pool.workers = []
+    pool.tags = ["red"]
+    pool.capacity = 8
+    pool.max_batch = 8
+
+    with pytest.raises(RuntimeError):
+        pool.evaluate(np.zeros((1, 512, 512, 3), dtype=np.uint8))
+
+
+def test_wrapper_follows_replaced_pool(img2txt, monkeypatch):
+
+    classifier = DeepDanbooruFakeClassifier()
+    first = FakePool(classifier.model.tags)
+    second = FakePool(classifier.model.tags)
+    current = [first]
+    monkeypatch.setattr(img2txt.DeepDanbooruProcessPool, "from_options", staticmethod(lambda: current[0]))
+
+    wrapper = img2txt.DeepDanbooruWrapper(classifier=classifier)
+    wrapper.use_profile = False
+    window = Image.new("RGB", (512, 512), (230, 20, 20))
+
+    wrapper.evaluate_batch([window], [""])
+    assert first.calls == 1
+
+    # A settings change closes the shared pool and starts another one
+    current[0] = second
+    assert wrapper.batch_capacity() == second.capacity
+    wrapper.evaluate_batch([window], [""])
+    assert (first.calls, second.calls) == (1, 1)
+
+    # Without workers the wrapper falls back to the model in this process
+    current[0] = None
+    results = wrapper.evaluate_batch([window], [""])
+    assert (first.calls, second.calls) == (1, 1)
+    assert len(results[0]) == len(classifier.model.tags)
@@ -0,0 +1,36 @@
+import numpy as np
+from PIL import Image
+
+
+def test_retained_wrapper_and_drawer_belong_to_one_image(img2txt):
+
+    script = img2txt.DeepDanbooruObjectRecognitionScript()
+    red = Image.new("RGB", (64, 64), (230, 20, 20))
+    blue = Image.new("RGB", (64, 64), (20, 20, 230))
+
+    red_wrapper = script.get_wrapper(red)
+    script.retain_drawer(red_wrapper, "red drawer")
+    assert script.retained(red) == (red_wrapper, "red drawer")
+
+    # Another session switches to another image, the red sweep finishing afterwards keeps nothing
+    blue_wrapper = script.get_wrapper(blue)
+    script.retain_drawer(red_wrapper, "red drawer")
+    assert script.retained(red) == (None, None)
+    assert script.retained(blue) == (blue_wrapper, None)
+
+
+def test_retained_cache_is_capped(img2txt, monkeypatch):
+
+    monkeypatch.setattr(img2txt.DeepDanbooruObjectRecognitionScript, "retained_windows", 4)
+    script = img2txt.DeepDanbooruObjectRecognitionScript()
+    im = Image.new("RGB", (64, 64), (230, 20, 20))
+
+    dd_wrapper = script.get_wrapper(im)
+    for i in range(6):
+        dd_wrapper.cache[f"0-0-{i}-{i}"] = np.zeros(1, dtype=np.float32)
+
+    # A hit makes the oldest window the most recently used
+    dd_wrapper.evaluate_batch([im], ["0-0-0-0"])
+
+    assert script.get_wrapper(im) is dd_wrapper
+    assert list(dd_wrapper.cache) == ["0-0-3-3", "0-0-4-4", "0-0-5-5", "0-0-0-0"]
@@ -0,0 +1,35 @@
+import os
+import time
+
+
+def old_request(root, name, days):
+
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "Best_red.png"), "wb") as _f:
+        _f.write(b"\0" * 1024)
+
+    mtime = time.time() - days * 24 * 60 * 60
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_retention_is_off_by_default(img2txt, outdir):
+
+    root = os.path.join(str(outdir), "ddor")
+    path = old_request(root, "before-upgrade", days=40)
+
+    assert img2txt.DeepDanbooruExportRetention.from_options(root).enforce() == 0
+    assert os.path.isdir(path)
+
+
+def test_retention_evicts_old_requests(img2txt, outdir, monkeypatch):
+
+    monkeypatch.setattr(img2txt.shared.opts, "img2txt_retention_max_days", 30)
+    root = os.path.join(str(outdir), "ddor")
+    old = old_request(root, "old", days=40)
+    recent = old_request(root, "recent", days=1)
+
+    assert img2txt.DeepDanbooruExportRetention.from_options(root).enforce() == 1
+    assert not os.path.exists(old)
+    assert os.path.isdir(recent)